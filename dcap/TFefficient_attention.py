@@ -23,6 +23,7 @@ import sys
 import tensorflow as tf
 from tensorflow.keras.layers import Dense
 from TFutils import sort_key_val, batched_index_select, process_inputs_chunk
+import utils as model_utils
 
 def debug_print(*args, **kwargs):
   #print(*args, **kwargs)
@@ -64,7 +65,7 @@ class TFLSHAttention():
         # See https://arxiv.org/pdf/1509.02897.pdf
         # Sample a different random rotation for each round of hashing to
         # decrease the probability of hash misses.
-        assert n_buckets % 2 == 0
+        assert not isinstance(n_buckets, int) or n_buckets % 2 == 0
 
         rot_size = n_buckets
 
@@ -75,7 +76,7 @@ class TFLSHAttention():
             rot_size // 2)
         debug_print('rotations_shape: ', rotations_shape)
 
-        random_rotations = tf.broadcast_to(tf.random.normal(rotations_shape), (batch_size, vecs.shape[-1], self.n_hashes, rot_size // 2))
+        random_rotations = tf.broadcast_to(model_utils.random_normal(rotations_shape), (batch_size, vecs.shape[-1], self.n_hashes, rot_size // 2))
 
         rotated_vecs = tf.einsum('btf,bfhi->bhti', vecs, random_rotations)
 
@@ -99,9 +100,12 @@ class TFLSHAttention():
           self.n_hashes = num_hashes
 
         _, seqlen, num_dims = qk.shape
+        if seqlen is None:
+            # inputs trimmed to a length bucket, seqlen must be a multiple of 2 * bucket_size
+            seqlen = tf.shape(qk)[1]
 
         debug_print('qk.shape/v.shape: ', qk.shape, v.shape)
-        assert padding_mask is None or seqlen == padding_mask.shape[1]
+        assert padding_mask is None or not isinstance(seqlen, int) or padding_mask.shape[1] in (None, seqlen)
 
         n_buckets = seqlen // self.bucket_size
         n_bins = n_buckets
@@ -117,10 +121,10 @@ class TFLSHAttention():
         #debug_print(tf.reduce_sum(tf.cast(tf.reduce_any(buckets_0_argsort[...,0,None] == buckets_0_argsort, 0)[:,1], tf.float32))/seqlen)
         #sys.exit(0)
         # We use the same vector as both a query and a key.
-        assert int(buckets.shape[1]) == self.n_hashes * seqlen
+        assert buckets.shape[1] is None or int(buckets.shape[1]) == self.n_hashes * seqlen
 
         ticker = tf.expand_dims(tf.range(self.n_hashes * seqlen), axis=0)
-        buckets_and_t = seqlen * buckets + tf.cast((ticker % seqlen), tf.int64)
+        buckets_and_t = tf.cast(seqlen, tf.int64) * buckets + tf.cast((ticker % seqlen), tf.int64)
         buckets_and_t = tf.stop_gradient(buckets_and_t)
         debug_print('buckets_and_t.shape: ', buckets_and_t.shape)
 
@@ -233,14 +237,14 @@ class TFLSHAttention():
             b_locs = tf.reshape(slocs, (-1, self.n_hashes * n_bins, self.bucket_size, 2 * self.n_hashes))
             b_locs1 = b_locs[:, :, :, None, :self.n_hashes]
 
-            bq_locs = tf.broadcast_to(b_locs1, b_locs.shape[:3] + (2, self.n_hashes))
-            bq_locs = tf.reshape(bq_locs, b_locs.shape)
+            bq_locs = tf.broadcast_to(b_locs1, tf.concat([tf.shape(b_locs)[:3], [2, self.n_hashes]], axis=0))
+            bq_locs = tf.reshape(bq_locs, tf.shape(b_locs))
             bkv_locs = look_one_back(b_locs)
 
             dup_counts = tf.math.reduce_sum(tf.cast(bq_locs[:, :, :, None, :] == bkv_locs[:, :, None, :, :], tf.float32), -1)
             dup_counts = tf.stop_gradient(dup_counts)
 
-            assert dup_counts.shape == dots.shape
+            assert dup_counts.shape.is_compatible_with(dots.shape)
             #dots = dots - tf.math.log(dup_counts + 1e-9) # doesn't work as dup_counts contains 0
             dots = tf.where(dup_counts <= 1, dots, dots - tf.math.log(dup_counts))
             del dup_counts
@@ -253,7 +257,7 @@ class TFLSHAttention():
         debug_print('dots_logsumexp.shape: ', dots_logsumexp.shape)
         dots = tf.exp(dots - dots_logsumexp) # weights matrix after softmax
         if self.dropout:
-          dots = tf.nn.dropout(dots, rate=dropout)
+          dots = model_utils.dropout(dots, self.dropout)
  
         bo = tf.einsum('buij,buje->buie', dots, bv)
         debug_print('bo.shape', bo.shape)
@@ -310,7 +314,7 @@ class TFLSHAttention():
             debug_print('calc.shape ', (o*probs).shape)
             out = tf.reduce_sum(o * probs, axis=1)
 
-        assert out.shape[1:] == v.shape[1:]
+        assert out.shape[1:].is_compatible_with(v.shape[1:])
         #return out, buckets
         return out
 
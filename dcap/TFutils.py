@@ -44,8 +44,8 @@ def process_inputs_chunk(fn, *args, chunks=1):
 def chunked_sum(tensor, chunks=1):
     *orig_size, last_dim = tensor.shape
     tensor = tf.reshape(tensor,  [-1, last_dim])
-    summed_tensors = [c.sum(axis=-1) for c in tf.chunk(tensor, chunks, axis=0)]
-    return tf.reshape(torch.concat(summed_tensors, axis=0), orig_size)
+    summed_tensors = [tf.reduce_sum(c, axis=-1) for c in tf.split(tensor, chunks, axis=0)]
+    return tf.reshape(tf.concat(summed_tensors, axis=0), orig_size)
 
 def cache_fn(f):
     cache = None
@@ -21,6 +21,7 @@ from __future__ import print_function
 from absl import flags
 import tensorflow as tf
 from official.nlp import bert_modeling as common_layer
+import utils as model_utils
 
 flags.DEFINE_enum('attention_padding_strategy', 'default', ['default', 'nopadding'],
     help='padding strategy in LSH attention computation')
@@ -137,9 +138,9 @@ class Attention(tf.keras.layers.Layer):
     # Note that softmax internally performs math operations using float32
     # for numeric stability. When training with float16, we keep the input
     # and output in float16 for better performance.
-    weights = tf.nn.softmax(logits, name="attention_weights")
+    weights = softmax_in_float32(logits, name="attention_weights")
     if training:
-      weights = tf.nn.dropout(weights, rate=self.attention_dropout)
+      weights = model_utils.dropout(weights, self.attention_dropout)
     attention_output = tf.einsum("BNFT,BTNH->BFNH", weights, value)
 
     # Run the outputs through another linear projection layer. Recombining heads
@@ -256,6 +257,13 @@ class LshSelfAttention(tf.keras.layers.Layer):
     return attention_output
 
 
+def softmax_in_float32(logits, name=None):
+  """Softmax, computed in float32 for bfloat16 logits as its 8-bit mantissa is too coarse for exp/sum."""
+  if logits.dtype == tf.bfloat16:
+    return tf.cast(tf.nn.softmax(tf.cast(logits, tf.float32), name=name), tf.bfloat16)
+  return tf.nn.softmax(logits, name=name)
+
+
 def calculate_full_attention(key, query, value, bias, training, attention_dropout):
   # Calculate dot product attention
   logits = tf.einsum("BTNH,BFNH->BNFT", key, query)
@@ -264,7 +272,7 @@ def calculate_full_attention(key, query, value, bias, training, attention_dropou
   # Note that softmax internally performs math operations using float32
   # for numeric stability. When training with float16, we keep the input
   # and output in float16 for better performance.
-  weights = tf.nn.softmax(logits, name="attention_weights")
+  weights = softmax_in_float32(logits, name="attention_weights")
 
   if training:
     weights = tf.nn.dropout(weights, rate=attention_dropout)
@@ -286,9 +294,13 @@ def calculate_full_attention_v2(query, key, value, padding_mask=None, apply_caus
     Attention output with shape [batch_size, value_length, num_heads, dim_per_head]
   """
   _, value_length, _, dim_per_head = value.shape
+  if value_length is None:
+    value_length = tf.shape(value)[1]
 
   query *= dim_per_head ** -0.5
   logits = tf.einsum("BFNH,BTNH->BNFT", query, key)
+  # masks and softmax in float32, also with bfloat16 mixed precision
+  logits = tf.cast(logits, tf.float32)
 
   if padding_mask is not None:
     logits += tf.cast(padding_mask, tf.float32)[:,None,None,:] * (-1e9)
@@ -299,9 +311,9 @@ def calculate_full_attention_v2(query, key, value, padding_mask=None, apply_caus
     self_mask_bias = tf.linalg.band_part(tf.ones([value_length, value_length], dtype=tf.float32), 0, 0)[None,None,:,:] * (-1e5)
     logits += self_mask_bias
 
-  weights = tf.nn.softmax(logits, name="attention_weights")
+  weights = tf.cast(tf.nn.softmax(logits, name="attention_weights"), value.dtype)
   if dropout:
-    weights = tf.nn.dropout(weights, rate=dropout)
+    weights = model_utils.dropout(weights, dropout)
 
   attentions = tf.einsum("BNFT,BTNH->BFNH", weights, value)
   return attentions
@@ -314,6 +326,11 @@ def calculate_LSH_attention(qk, value, padding_mask=None, dropout=0, num_hashes=
     lsh_att = TFefficient_attention.TFLSHAttention(dropout = dropout, n_hashes=num_hashes, bucket_size=bucket_size, causal=False, allow_duplicate_attention=allow_duplicated_attention)
 
   batch_size, length, num_heads, num_dim = qk.shape
+  if length is None:
+    length = tf.shape(qk)[1]
+  # hashing, sorting and softmax of LSH attention run in float32, also with mixed precision
+  output_dtype = value.dtype
+  qk, value = tf.cast(qk, tf.float32), tf.cast(value, tf.float32)
   qk = tf.reshape(tf.transpose(qk, perm=[0,2,1,3]), (-1, length, num_dim))
   value = tf.reshape(tf.transpose(value, perm=[0,2,1,3]), (-1, length, num_dim))
   #TODO: not efficient to expand padding_mask here
@@ -321,7 +338,7 @@ def calculate_LSH_attention(qk, value, padding_mask=None, dropout=0, num_hashes=
     padding_mask = tf.keras.backend.repeat_elements(padding_mask, rep=num_heads, axis=0)
   ret = lsh_att.call(qk, value, padding_mask, num_hashes=num_hashes)
   ret = tf.transpose(tf.reshape(ret, (-1, num_heads, length, num_dim)), perm=[0,2,1,3])
-  return ret
+  return tf.cast(ret, output_dtype)
 
 def get_self_attention_mask(length, dtype=tf.float32):
 	with tf.name_scope("self_attention_bias"):
@@ -0,0 +1,122 @@
+"""Tune the batch size, threading and input parallelism of training on this machine.
+
+--mode=autotune runs short --mode=bench-train trials, every one in a new
+process since the thread pools of TF can't be resized once it has started.
+All other flags of the command line are passed to the trials as they are, so
+tune with the model, data and dtype you train with, e.g.
+
+  python3 dtitle.py --mode=autotune --tuned_config_file=tuned.json \\
+      --param_set=base --data_dir=... --vocab_file=... --bench_train_steps=20
+
+The search is coordinate-wise to keep the number of trials small:
+  1. the largest examples/s over --autotune_batch_sizes, in increasing order,
+     stopping at the first trial that fails (e.g. out of memory) or exceeds
+     --autotune_max_rss_mb;
+  2. intra-op x inter-op thread counts, with that batch size;
+  3. --autotune_num_parallel_calls of the input pipeline map stages.
+
+The best configuration is written to --tuned_config_file, which train and
+predict load when it's set. Predict takes the threading and input settings
+but keeps its own batch_size, as bench-train measures training batches.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+from absl import logging
+
+
+TUNED_FLAGS = ('batch_size', 'intra_op_parallelism_threads', 'inter_op_parallelism_threads', 'num_parallel_calls')
+
+_RESULT_PREFIX = 'bench-train result: '
+
+
+def run_trial(config):
+  """Runs bench-train with the flag values of config in a new process, returns its result, None if it failed."""
+  cmd = [sys.executable] + sys.argv + ['--mode=bench-train'] + [f'--{name}={value}' for name, value in config.items()]
+  proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+  for line in proc.stdout.splitlines():
+    if _RESULT_PREFIX in line:
+      return json.loads(line.split(_RESULT_PREFIX, 1)[1])
+  logging.warning(f'trial {config} failed with exit code {proc.returncode}:\n{proc.stdout[-2000:]}')
+  return None
+
+
+def thread_candidates(num_cores):
+  """Returns (intra_op, inter_op) thread counts to try on num_cores cores."""
+  intra_ops = sorted({num_cores, max(num_cores // 2, 1), max(num_cores // 4, 1)}, reverse=True)
+  return [(intra_op, inter_op) for intra_op in intra_ops for inter_op in (1, 2, 4)]
+
+
+def autotune(flags_obj):
+  """Searches the configuration of the highest training examples/s, and writes it to flags_obj.tuned_config_file."""
+  if not flags_obj.tuned_config_file:
+    raise ValueError('--mode=autotune requires --tuned_config_file')
+  max_rss_mb = flags_obj.autotune_max_rss_mb
+  trials = []
+
+  def _try(config):
+    result = run_trial(config)
+    if result and max_rss_mb and result['peak_rss_mb'] > max_rss_mb:
+      logging.info(f'trial {config} exceeds the memory ceiling: {result["peak_rss_mb"]:.0f} > {max_rss_mb} MB')
+      result = None
+    trials.append({'config': config, 'result': result})
+    if result:
+      logging.info(f'trial {config}: {result["examples_per_sec"]:.1f} examples/s, {result["peak_rss_mb"]:.0f} MB')
+    return result
+
+  best_config = {
+      'batch_size': flags_obj.batch_size,
+      'intra_op_parallelism_threads': flags_obj.intra_op_parallelism_threads,
+      'inter_op_parallelism_threads': flags_obj.inter_op_parallelism_threads,
+      'num_parallel_calls': flags_obj.num_parallel_calls or 0,
+  }
+  best_result = None
+
+  def _search(name_values, stop_on_failure=False):
+    """Tries best_config updated by every one of name_values ({flag: value} dicts)."""
+    nonlocal best_config, best_result
+    for values in name_values:
+      config = dict(best_config, **values)
+      if best_result and config == best_config:
+        continue
+      result = _try(config)
+      if result is None:
+        if stop_on_failure:
+          break
+        continue
+      if best_result is None or result['examples_per_sec'] > best_result['examples_per_sec']:
+        best_config, best_result = config, result
+
+  _search([{'batch_size': batch_size} for batch_size in sorted(map(int, flags_obj.autotune_batch_sizes))],
+          stop_on_failure=True)
+  if best_result is None:
+    raise RuntimeError(f'all batch sizes failed or exceed the memory ceiling of {max_rss_mb} MB')
+  _search([{'intra_op_parallelism_threads': intra_op, 'inter_op_parallelism_threads': inter_op}
+           for intra_op, inter_op in thread_candidates(len(os.sched_getaffinity(0)))])
+  _search([{'num_parallel_calls': int(n)} for n in flags_obj.autotune_num_parallel_calls])
+
+  with open(flags_obj.tuned_config_file, 'w') as f:
+    json.dump({'config': best_config, 'result': best_result, 'trials': trials}, f, indent=2)
+
+  rows = [[str(trial['config'][name]) for name in TUNED_FLAGS]
+          + ([f'{trial["result"]["examples_per_sec"]:.1f}', f'{trial["result"]["peak_rss_mb"]:.0f}'] if trial['result'] else ['failed', '-'])
+          for trial in trials]
+  table = '\n'.join('\t'.join(row) for row in [list(TUNED_FLAGS) + ['examples/s', 'peak_rss_mb']] + rows)
+  logging.info(f'autotune trials:\n{table}')
+  logging.info(f'wrote the best configuration {best_config} ({best_result["examples_per_sec"]:.1f} examples/s) '
+               f'to {flags_obj.tuned_config_file}')
+  return best_config
+
+
+def load_tuned_config(flags_obj, mode):
+  """Overrides the tuned flags of flags_obj by the configuration in flags_obj.tuned_config_file."""
+  with open(flags_obj.tuned_config_file) as f:
+    config = json.load(f)['config']
+  if mode != 'train':
+    config.pop('batch_size', None)
+  for name, value in config.items():
+    setattr(flags_obj, name, value)
+  logging.info(f'loaded the tuned configuration {config} from {flags_obj.tuned_config_file}')
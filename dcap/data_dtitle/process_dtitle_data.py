@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import re
 import time
 import gzip
 import collections
+import shutil
+import multiprocessing
 from multiprocessing import Pool
 from functools import partial
 
 from absl import app
 from absl import flags
 
+import numpy as np
 import tensorflow as tf
 import tensorflow_datasets as tfds
 
@@ -287,6 +291,125 @@ def tokenize_dtitle_v2(FLAGS):
 	print(f'complete tokenization of {FLAGS.input_file}, token limit = {FLAGS.html_token_limit}. write {count} records to {tfrecord_file}.')
 
 
+def _bincount_protos(protos, columns, vocab_size):
+	"""Returns {column: int64 tensor of vocab_size token counts} of a batch of serialized tokenized examples."""
+	description = {col: tf.io.RaggedFeature(tf.int64, row_splits_dtype=tf.int64) for col in columns}
+	ex = tf.io.parse_example(protos, description)
+	return {col: tf.math.bincount(tf.cast(ex[col].flat_values, tf.int32), minlength=vocab_size, maxlength=vocab_size, dtype=tf.int64) for col in columns}
+
+
+def _count_token_freq_protos(protos, columns, vocab_size):
+	"""Returns {column: int64 array of vocab_size token counts} of a batch of serialized tokenized examples."""
+	return {col: value.numpy() for col, value in _bincount_protos(protos, columns, vocab_size).items()}
+
+
+def _count_token_freq_file(data_file, columns, vocab_size):
+	"""Returns {column: int64 array of vocab_size token counts} of a tokenized file."""
+	ds = tf.data.TFRecordDataset(data_file, 'GZIP' if data_file.endswith('.gz') else None)
+	ds = ds.batch(4096).map(lambda protos: _bincount_protos(protos, columns, vocab_size), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+	freq = ds.reduce({col: tf.zeros([vocab_size], tf.int64) for col in columns},
+			lambda total, counts: {col: total[col] + counts[col] for col in columns})
+	print(f'counted {data_file} at {time.asctime()}', file=sys.stderr)
+	return {col: value.numpy() for col, value in freq.items()}
+
+
+def count_token_freq(FLAGS):
+	"""Writes per-column token histograms of tokenized files as dense arrays next to the vocab.
+
+	With at least as many files as processes, every process counts whole files.
+	Otherwise every file is decompressed once, by this process, and batches of
+	its records are fanned out to the processes to be parsed and counted.
+	"""
+	_initialize_tokenizer(FLAGS.vocab_file)
+	vocab_size = _tokenizer.vocab_size
+	columns = FLAGS.dtitle_schema.split(',')
+	files = sorted(tf.io.gfile.glob(FLAGS.input_file))
+	assert files, f'no file matches {FLAGS.input_file}'
+
+	processes = FLAGS.num_processes or multiprocessing.cpu_count()
+	freq = {col: np.zeros([vocab_size], np.int64) for col in columns}
+	def _add(counts):
+		for col in columns:
+			freq[col] += counts[col]
+
+	# spawn the workers, TF runtime is not fork-safe
+	with multiprocessing.get_context('spawn').Pool(processes) as pool:
+		if len(files) >= processes:
+			for counts in pool.starmap(_count_token_freq_file, [(fp, columns, vocab_size) for fp in files]):
+				_add(counts)
+		else:
+			# a bounded number of batches in flight, so the reader doesn't run ahead of the workers
+			pending = collections.deque()
+			for fp in files:
+				records = tf.data.TFRecordDataset(fp, 'GZIP' if fp.endswith('.gz') else None).batch(4096)
+				for protos in records.prefetch(tf.data.experimental.AUTOTUNE):
+					pending.append(pool.apply_async(_count_token_freq_protos, (protos.numpy(), columns, vocab_size)))
+					if len(pending) >= 2 * processes:
+						_add(pending.popleft().get())
+				print(f'read {fp} at {time.asctime()}', file=sys.stderr)
+			while pending:
+				_add(pending.popleft().get())
+
+	freq_file = FLAGS.vocab_file + '.token-freq.npz'
+	np.savez(freq_file, **freq)
+	for col in columns:
+		print(f'{col}: {freq[col].sum()} tokens, {np.count_nonzero(freq[col])} distinct token ids')
+	print(f'write token frequency of {len(files)} file(s) to {freq_file}.')
+
+
+def _write_npy_from_raw(raw_file, npy_file, dtype):
+	"""Prepends a .npy header to a raw little-endian 1-D array file, streaming the data."""
+	dtype = np.dtype(dtype)
+	header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (os.path.getsize(raw_file) // dtype.itemsize,)}
+	with open(npy_file, 'wb') as fo, open(raw_file, 'rb') as fi:
+		np.lib.format.write_array_header_1_0(fo, header)
+		shutil.copyfileobj(fi, fo, 16 << 20)
+	os.remove(raw_file)
+
+
+def convert_to_mmap(FLAGS):
+	"""Converts a tokenized file to a .dtitle.mmap directory to be memory-mapped by dtitle.py.
+
+	Every column is stored as {col}.ids.npy, the flat uint16 token ids of all
+	rows, and {col}.offsets.npy, the int64 start offset of every row plus the
+	total length, so row i is ids[offsets[i]:offsets[i+1]].
+	"""
+	_initialize_tokenizer(FLAGS.vocab_file)
+	assert _tokenizer.vocab_size <= 1 << 16, f'vocab_size {_tokenizer.vocab_size} doesn\'t fit in uint16'
+	assert FLAGS.input_file.endswith('.dtitle.tokenized.gz')
+	mmap_dir = FLAGS.input_file[:-len('.tokenized.gz')] + '.mmap'
+	tmp_dir = mmap_dir + '.tmp'
+	os.makedirs(tmp_dir, exist_ok=True)
+
+	columns = FLAGS.dtitle_schema.split(',')
+	description = {col: tf.io.RaggedFeature(tf.int64, row_splits_dtype=tf.int64) for col in columns}
+	ds = tf.data.TFRecordDataset(FLAGS.input_file, 'GZIP').batch(4096)
+	ds = ds.map(lambda protos: tf.io.parse_example(protos, description), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+	ids_files = {col: open(os.path.join(tmp_dir, f'{col}.ids.raw'), 'wb') for col in columns}
+	offsets_files = {col: open(os.path.join(tmp_dir, f'{col}.offsets.raw'), 'wb') for col in columns}
+	totals = {col: 0 for col in columns}
+	for col in columns:
+		offsets_files[col].write(np.zeros([1], '<i8').tobytes())
+	count = 0
+	for ex in ds:
+		for col in columns:
+			ids_files[col].write(ex[col].flat_values.numpy().astype('<u2').tobytes())
+			offsets = totals[col] + np.cumsum(ex[col].row_lengths().numpy())
+			offsets_files[col].write(offsets.astype('<i8').tobytes())
+			totals[col] = int(offsets[-1])
+		count += int(ex[columns[0]].nrows())
+	for col in columns:
+		ids_files[col].close()
+		offsets_files[col].close()
+		_write_npy_from_raw(os.path.join(tmp_dir, f'{col}.ids.raw'), os.path.join(tmp_dir, f'{col}.ids.npy'), '<u2')
+		_write_npy_from_raw(os.path.join(tmp_dir, f'{col}.offsets.raw'), os.path.join(tmp_dir, f'{col}.offsets.npy'), '<i8')
+	if os.path.exists(mmap_dir):
+		shutil.rmtree(mmap_dir)
+	os.rename(tmp_dir, mmap_dir)
+	print(f'convert {count} records of {FLAGS.input_file} to {mmap_dir}, {sum(totals.values())} tokens in {len(columns)} columns.')
+
+
 def print_flags(FLAGS, file=None):
 	print('FLAGS:', file=file)
 	for f in FLAGS.get_key_flags_for_module(__file__):
@@ -332,10 +455,14 @@ def main(_):
 		check_stats(FLAGS)
 	elif FLAGS.cmd == 'print-flags':
 		print_flags(FLAGS)
+	elif FLAGS.cmd == 'count-token-freq':
+		count_token_freq(FLAGS)
+	elif FLAGS.cmd == 'convert-to-mmap':
+		convert_to_mmap(FLAGS)
 
 
 if __name__ == '__main__':
-	flags.DEFINE_enum('cmd', None, ['pre-process', 'build-vocab', 'check-stats', 'print-flags', 'tokenize-dtitle', 'tokenize-dtitle-mp', 'tokenize-dtitle-v2'], 'the command to execute')
+	flags.DEFINE_enum('cmd', None, ['pre-process', 'build-vocab', 'check-stats', 'print-flags', 'tokenize-dtitle', 'tokenize-dtitle-mp', 'tokenize-dtitle-v2', 'count-token-freq', 'convert-to-mmap'], 'the command to execute')
 	flags.mark_flag_as_required('cmd')
 	flags.DEFINE_string('input_file', None, 'input dtitle file name for pre-process and build-vocab')
 	# params for dtitle_reader
@@ -370,5 +497,7 @@ if __name__ == '__main__':
 	flags.DEFINE_integer('head_token_limit', 256, 'max allowed token count for htmlhead, 0 means no limit (1M tokens)')
 	flags.DEFINE_integer('default_token_limit', 256, 'max allowed token count for fields other than htmlhead/body')
 	flags.DEFINE_enum('compression_type', 'GZIP', ['', 'GZIP'], 'compression type used for tfrecord files')
+	# params for count-token-freq
+	flags.DEFINE_integer('num_processes', 0, 'number of processes to count token frequency, 0 means cpu count')
 
 	app.run(main)
@@ -0,0 +1,78 @@
+"""Run the input pipeline in local tf.data service processes.
+
+The trainer builds the dataset graph as usual, then sends it to a dispatcher
+running in a separate process. One or more worker processes run the
+parse/filter/pad stages and stream finished batches back to the trainer over a
+localhost grpc socket, so preprocessing no longer competes with the trainer's
+own intra/inter-op threads.
+
+How many workers to run per training process:
+  * start with 1 worker; each worker owns its own tf.data AUTOTUNE thread pool.
+  * add one worker at a time while training examples/s still grows, i.e. while
+    the trainer is input-bound (see --mode=bench-input / step stats).
+  * every worker still decompresses the whole file and parses 1/N of the
+    records, so stop adding workers once decompression, rather than parsing,
+    dominates.
+  * keep (workers * cores used per worker) + trainer threads <= cores of the
+    host, otherwise workers and trainer fight for the same cores again.
+
+Requires TF 2.7+ (tf.data.experimental.service with ShardingPolicy.HINT).
+Datasets that use tf.py_function (the raw .dtitle text format) can't be
+served, as the graph is executed in another process.
+"""
+
+import multiprocessing
+
+from absl import logging
+import tensorflow as tf
+
+
+def _run_dispatcher(port, worker_addresses):
+  config = tf.data.experimental.service.DispatcherConfig(port=port, worker_addresses=worker_addresses)
+  server = tf.data.experimental.service.DispatchServer(config)
+  server.join()
+
+
+def _run_worker(dispatcher_address, port):
+  config = tf.data.experimental.service.WorkerConfig(
+      dispatcher_address=dispatcher_address, worker_address=f'localhost:{port}', port=port)
+  server = tf.data.experimental.service.WorkerServer(config)
+  server.join()
+
+
+class LocalDataService():
+  """A tf.data service dispatcher and N workers, each in its own process on localhost."""
+
+  def __init__(self, num_workers, port):
+    self.num_workers = num_workers
+    self.port = port
+    self.worker_ports = [port + 1 + idx for idx in range(num_workers)]
+    self.processes = []
+
+  @property
+  def address(self):
+    return f'grpc://localhost:{self.port}'
+
+  def start(self):
+    # spawn (instead of fork) so that the servers don't inherit the TF runtime of the trainer
+    ctx = multiprocessing.get_context('spawn')
+    worker_addresses = [f'localhost:{p}' for p in self.worker_ports]
+    self.processes.append(ctx.Process(target=_run_dispatcher, args=(self.port, worker_addresses), daemon=True))
+    for p in self.worker_ports:
+      self.processes.append(ctx.Process(target=_run_worker, args=(f'localhost:{self.port}', p), daemon=True))
+    for proc in self.processes:
+      proc.start()
+    logging.info(f'started tf.data service at {self.address} with {self.num_workers} worker(s) on ports {self.worker_ports}')
+
+  def distribute(self, ds):
+    """Let the service workers produce ds; records are sharded across workers by SHARD_HINT."""
+    return ds.apply(tf.data.experimental.service.distribute(
+        processing_mode=tf.data.experimental.service.ShardingPolicy.HINT,
+        service=self.address))
+
+  def stop(self):
+    for proc in self.processes:
+      proc.terminate()
+    for proc in self.processes:
+      proc.join()
+    self.processes = []
@@ -12,7 +12,12 @@ import sys
 import time
 import re
 import html
+import json
+import shutil
+import tempfile
 import collections
+import inspect
+import resource
 import numpy as np
 
 from absl import app
@@ -25,12 +30,16 @@ import tensorflow_datasets as tfds
 import misc
 import transformer
 import reformer
+import attention_layer
 from official.transformer.v2 import optimizer
 from official.utils.flags import core as flags_core
 from official.utils.misc import keras_utils
 from official.utils.misc import distribution_utils
 import metrics
 import utils
+import data_service as data_service_lib
+import multi_worker
+import autotune
 
 from data_dtitle.process_dtitle_data import dtitle_reader
 
@@ -71,6 +80,26 @@ class Seq2SeqTask():
     params["test_num_hashes"] = flags_obj.test_num_hashes
     params["use_full_attention_in_reformer"] = flags_obj.use_full_attention_in_reformer
     params["bucket_size"] = flags_obj.bucket_size
+    params["trim_input_length"] = bool(flags_obj.length_buckets)
+    params["grad_accum_steps"] = flags_obj.grad_accum_steps
+    uses_fit = flags_obj.mode == 'bench-train' or (flags_obj.mode == 'train' and not flags_obj.use_ctl)
+    if flags_obj.grad_accum_steps > 1 and uses_fit and not hasattr(tf.keras.Model, 'train_step'):
+      # TF < 2.2 ignores the train_step of utils.GradientAccumulationModel, and would feed the
+      # [batch_size, grad_accum_steps, length] micro-batches to the model as they are
+      raise ValueError('--grad_accum_steps > 1 with Keras fit requires TF 2.2+, use --use_ctl on older TF')
+    params["recompute_encoder_layers"] = flags_obj.recompute_encoder_layers
+    params["reversible_encoder"] = flags_obj.reversible_encoder
+    if flags_obj.reversible_encoder and flags_obj.recompute_encoder_layers:
+      # reformer.RevEncoderStack reconstructs and recomputes every layer in the backward pass already
+      raise ValueError('--reversible_encoder and --recompute_encoder_layers can\'t be used together, '
+                       'reversible layers recompute their activations already')
+    params["ffn_chunk_size"] = flags_obj.ffn_chunk_size
+    params["logits_chunk_size"] = flags_obj.logits_chunk_size
+    # XLA compiles for static shapes: model inputs are padded to max lengths (or length buckets),
+    # and beam search runs on the fixed-size cache of padded decoding
+    params["static_shapes"] = flags_obj.enable_xla
+    if flags_obj.enable_xla:
+      params["padded_decode"] = True
 
     if flags_obj.one_dropout is not None:
       params['layer_postprocess_dropout'] = flags_obj.one_dropout
@@ -87,6 +116,10 @@ class Seq2SeqTask():
     self.EOS_id = self.tokenizer.encode('<EOS>')[0]
     params["vocab_size"] = self.tokenizer.vocab_size
     logging.info('loaded vocab from {}, vocab_size={} and EOS_id={}'.format(self.flags_obj.vocab_file, self.tokenizer.vocab_size, self.EOS_id))
+    if flags_obj.input_concat_schema == 'v4':
+      # segments are packed back-to-back, each ends with <EOS#i> = EOS_id + 11 + i
+      params["segment_end_id"] = self.EOS_id + 11
+      params["num_segment_types"] = self._MAX_INPUT_SEGMENTS
     logging.info(f'training_schema = [{self.flags_obj.training_schema}]')
 
     if params["dtype"] == tf.float16:
@@ -99,6 +132,11 @@ class Seq2SeqTask():
       policy = tf.compat.v2.keras.mixed_precision.experimental.Policy(
           "mixed_float16", loss_scale=loss_scale)
       tf.compat.v2.keras.mixed_precision.experimental.set_policy(policy)
+    elif params["dtype"] == tf.bfloat16:
+      # bfloat16 has the exponent range of float32, so no loss scaling. Variables,
+      # softmax, layer norm and the loss stay in float32.
+      policy = tf.compat.v2.keras.mixed_precision.experimental.Policy("mixed_bfloat16")
+      tf.compat.v2.keras.mixed_precision.experimental.set_policy(policy)
 
     self.distribution_strategy = distribution_utils.get_distribution_strategy(
         distribution_strategy=flags_obj.distribution_strategy,
@@ -109,6 +147,11 @@ class Seq2SeqTask():
     if self.distribution_strategy:
       logging.info("For training, using distribution strategy: %s",
                    self.distribution_strategy)
+      if flags_obj.distribution_strategy == 'multi_worker_mirrored':
+        # one replica per worker process, batch_size is per worker
+        params["batch_size"] = flags_obj.batch_size * self.distribution_strategy.num_replicas_in_sync
+        logging.info(f'multi-worker (num_workers, task_index) = {multi_worker.get_worker_info()}, '
+                     f'actual batch_size = {flags_obj.batch_size} * {self.distribution_strategy.num_replicas_in_sync}')
     else:
       logging.info("Not using any distribution strategy.")
 
@@ -129,28 +172,76 @@ class Seq2SeqTask():
     keras_utils.set_session_config(
         enable_xla=flags_obj.enable_xla)
 
-    train_ds = self._create_dataset(params['data_dir'], repeat=None)
+    os.makedirs(flags_obj.model_dir, exist_ok=True)
+    # only the chief writes to model_dir, other workers of multi_worker_mirrored save
+    # (which every worker must take part in) and log to a local temp dir
+    log_dir = flags_obj.model_dir if multi_worker.is_chief() else self._worker_temp_dir()
+
+    data_service = None
+    if flags_obj.data_service_workers:
+      # servers are daemon processes, they are terminated together with this process
+      data_service = data_service_lib.LocalDataService(flags_obj.data_service_workers, flags_obj.data_service_port)
+      data_service.start()
+    input_shard = None
+    if flags_obj.distribution_strategy == 'multi_worker_mirrored':
+      # every worker reads a disjoint shard of the training data
+      input_shard = multi_worker.get_worker_info()
+    train_ds = self._create_dataset(params['data_dir'], repeat=None, shuffle_memory_mb=flags_obj.shuffle_memory_mb,
+                                    data_service=data_service, input_shard=input_shard)
+    if flags_obj.grad_accum_steps > 1:
+      train_ds = self._group_micro_batches(train_ds, flags_obj.grad_accum_steps)
+    # one profiler for the whole run, whose steps are counted across the fit calls
+    self._train_profiler = utils.ProfilerCallback(log_dir, flags_obj.profile_steps, 'train') if flags_obj.profile_steps else None
+    checkpoint_input_iterator = flags_obj.checkpoint_input_iterator
+    if checkpoint_input_iterator:
+      if data_service or input_shard or re.search(r'\.dtitle(\.gz|\.mmap)?$', params['data_dir']):
+        logging.warning('the input iterator of tf.data service, multiple workers, .dtitle text or mmap format can\'t be checkpointed, ignore --checkpoint_input_iterator')
+        checkpoint_input_iterator = False
+      elif self.distribution_strategy and self.distribution_strategy.num_replicas_in_sync > 1:
+        # the training loop reads the distributed dataset of the replicas, not this iterator
+        logging.warning('the input iterator of multiple replicas can\'t be checkpointed, ignore --checkpoint_input_iterator')
+        checkpoint_input_iterator = False
+    self._batch_handovers = None
+    if flags_obj.enable_step_stats:
+      if checkpoint_input_iterator:
+        logging.warning('the input iterator with step stats instrumentation (a py_function) can\'t be checkpointed, input wait is not measured')
+      else:
+        self._batch_handovers = collections.deque()
+        train_ds = utils.instrument_batches(train_ds, self._batch_handovers)
+        if self.distribution_strategy and self.distribution_strategy.num_replicas_in_sync > 1:
+          logging.warning('the distributed input iterator prefetches batches, the input wait of step stats '
+                          'is the time to dequeue a prefetched batch rather than to produce one')
+    train_iterator = iter(train_ds) if checkpoint_input_iterator else None
     val_ds = self._create_dataset(params['val_data_dir'] or re.sub(r'-training.*', '-test.dtitle.tokenized.gz', params['data_dir']), repeat=1)
     val_ds = val_ds.take(flags_obj.validation_example_count // params["batch_size"]).cache()
 
     with distribution_utils.get_strategy_scope(self.distribution_strategy):
       model = self.create_model(mode='train')
-      model.compile(optimizer=self._create_optimizer(params), loss=self._create_loss_fn(params))
-
-    if not os.path.exists(flags_obj.model_dir):
-      os.mkdir(flags_obj.model_dir)
+      model.compile(optimizer=self._create_optimizer(params), loss=self._create_loss_fn(params), **self._jit_compile_args())
 
     current_step = 0
-    checkpoint = tf.train.Checkpoint(model=model)
+    # the iterator is saved with its position (and buffered elements), so a resumed training skips the consumed examples
+    checkpoint = tf.train.Checkpoint(model=model, train_iterator=train_iterator) if train_iterator is not None else tf.train.Checkpoint(model=model)
     ckpt_mgr = tf.train.CheckpointManager(checkpoint, flags_obj.model_dir, max_to_keep=3, keep_checkpoint_every_n_hours=24)
-    if ckpt_mgr.latest_checkpoint:
+    # checkpoints saved within an epoch (by step/time interval or on SIGTERM), numbered by step
+    interim_ckpt_mgr = tf.train.CheckpointManager(checkpoint, os.path.join(flags_obj.model_dir, 'interim'), max_to_keep=1)
+    latest_checkpoint = self._latest_checkpoint(ckpt_mgr, interim_ckpt_mgr)
+    if latest_checkpoint:
       #self._print_variables_and_exit(flags_obj.model_dir)
-      model.fit([tf.ones([params["batch_size"], params['max_input_length']], tf.int32), tf.ones([params["batch_size"], params['max_target_length']], tf.int32)],
-                tf.ones([params["batch_size"], params['max_target_length']], tf.int32),
-                verbose=0)
-      checkpoint.restore(ckpt_mgr.latest_checkpoint).assert_consumed()
-      current_step = model.optimizer.iterations.numpy() - 1
-      logging.info("Loaded checkpoint %s, current_step %d", ckpt_mgr.latest_checkpoint, current_step)
+      # model variables are built by create_model; optimizer slots don't exist before the first
+      # training step, their values are restored (deferred) when they are created.
+      model.optimizer.iterations  # creates the step counter, so it's restored right now
+      saved_names = [name for name, _ in tf.train.list_variables(latest_checkpoint)]
+      if train_iterator is not None and not any(name.startswith('train_iterator/') for name in saved_names):
+        logging.warning(f'no input iterator in {latest_checkpoint}, read training data from the beginning')
+        tf.train.Checkpoint(model=model).restore(latest_checkpoint).assert_existing_objects_matched()
+      else:
+        checkpoint.restore(latest_checkpoint).assert_existing_objects_matched()
+      current_step = int(model.optimizer.iterations.numpy())
+      logging.info("Loaded checkpoint %s, current_step %d", latest_checkpoint, current_step)
+    if log_dir != flags_obj.model_dir:
+      ckpt_mgr = tf.train.CheckpointManager(checkpoint, log_dir, max_to_keep=1)
+      interim_ckpt_mgr = tf.train.CheckpointManager(checkpoint, os.path.join(log_dir, 'interim'), max_to_keep=1)
 
     if current_step >= flags_obj.train_steps:
       logging.info("Reach the target train_steps({}) and exit.".format(flags_obj.train_steps))
@@ -159,26 +250,205 @@ class Seq2SeqTask():
     logging.info(f'Start train iteration at global step: {current_step}')
     model.summary()
     #print(model.variables)
-    history = model.fit(
-        train_ds,
-        initial_epoch=current_step // flags_obj.steps_between_evals,
-        epochs=(flags_obj.train_steps-1) // flags_obj.steps_between_evals + 1,
-        steps_per_epoch=min(flags_obj.steps_between_evals, flags_obj.train_steps - current_step),
-        callbacks=self._create_callbacks(flags_obj.model_dir, current_step, flags_obj.steps_between_evals, params, ckpt_mgr),
-        validation_data=val_ds,
-        validation_steps=flags_obj.validation_example_count // params["batch_size"], # redundant but suppress one warining
-        verbose=1)
+    if flags_obj.use_ctl or train_iterator is not None:
+      if not flags_obj.use_ctl:
+        # model.fit would read a python iterator like a generator, i.e. every batch through python without prefetch;
+        # the train function of the custom training loop reads the checkpointed iterator itself
+        logging.info('train with the custom training loop, which reads the checkpointed input iterator')
+      history = self._train_with_ctl(model, train_iterator, train_ds, val_ds, log_dir, ckpt_mgr, interim_ckpt_mgr, current_step)
+    else:
+      history = self._train_with_fit(model, train_ds, val_ds, log_dir, ckpt_mgr, interim_ckpt_mgr, current_step)
+    if hasattr(checkpoint, 'sync'):
+      checkpoint.sync()  # wait for the async checkpoint writes (TF 2.12+)
+    if log_dir != flags_obj.model_dir:
+      shutil.rmtree(log_dir, ignore_errors=True)
     logging.info("Train history: {}".format(history.history))
-    current_step = model.optimizer.iterations.numpy() - 1
+    current_step = int(model.optimizer.iterations.numpy())
     logging.info("End train iteration at global step:{}".format(current_step))
 
     return history
 
+  def _worker_temp_dir(self):
+    num_workers, task_index = multi_worker.get_worker_info()
+    return os.path.join(tempfile.gettempdir(), f'dtitle-worker{task_index}-of-{num_workers}-{os.getpid()}')
+
+  def _train_with_fit(self, model, train_ds, val_ds, log_dir, ckpt_mgr, interim_ckpt_mgr, current_step):
+    """Trains the compiled model with model.fit from current_step.
+
+    When resumed from an interim checkpoint in the middle of an epoch, the rest of
+    that epoch is trained by a separate fit, so that every later epoch (and its
+    checkpoint) still ends at a multiple of steps_between_evals.
+    """
+    flags_obj = self.flags_obj
+    steps_per_epoch = flags_obj.steps_between_evals
+    history = None
+    while current_step < flags_obj.train_steps:
+      epoch = current_step // steps_per_epoch
+      epoch_steps = min(steps_per_epoch - current_step % steps_per_epoch, flags_obj.train_steps - current_step)
+      history = model.fit(
+          train_ds,
+          initial_epoch=epoch,
+          epochs=epoch + 1 if current_step % steps_per_epoch else (flags_obj.train_steps-1) // steps_per_epoch + 1,
+          steps_per_epoch=epoch_steps,
+          callbacks=self._create_callbacks(log_dir, current_step, steps_per_epoch, self.params, ckpt_mgr,
+                                           interim_ckpt_mgr=interim_ckpt_mgr),
+          validation_data=val_ds,
+          validation_steps=flags_obj.validation_example_count // self.params["batch_size"], # redundant but suppress one warining
+          verbose=1)
+      if model.stop_training:  # preempted
+        break
+      current_step = int(model.optimizer.iterations.numpy())
+    return history
+
+  def _checkpoint_step(self, path):
+    """Returns the training step (optimizer iterations) saved in checkpoint path, -1 if there's none."""
+    for name, _ in tf.train.list_variables(path):
+      if name.endswith('optimizer/iter/.ATTRIBUTES/VARIABLE_VALUE'):
+        return int(tf.train.load_variable(path, name))
+    return -1
+
+  def _latest_checkpoint(self, ckpt_mgr, interim_ckpt_mgr):
+    """Returns the one of the latest epoch and interim checkpoints with more training steps."""
+    paths = [path for path in [ckpt_mgr.latest_checkpoint, interim_ckpt_mgr.latest_checkpoint] if path]
+    # on a tie the epoch checkpoint wins
+    return max(paths, key=self._checkpoint_step) if paths else None
+
+  def _train_with_ctl(self, model, train_iterator, train_ds, val_ds, log_dir, ckpt_mgr, interim_ckpt_mgr, current_step):
+    """Trains the compiled model with a custom training loop, instead of model.fit.
+
+    Every call of the compiled train_steps function runs steps_per_loop steps
+    on a distributed iterator, so python only runs once per loop. The learning
+    rate schedule, checkpoints (one per steps_between_evals), history CSV and
+    TensorBoard logs follow the model.fit path.
+    """
+    params, flags_obj = self.params, self.flags_obj
+    strategy = self.distribution_strategy or tf.distribute.get_strategy()
+    steps_per_epoch = flags_obj.steps_between_evals
+    # step stats and the profiler handle every step from python
+    per_step = flags_obj.enable_step_stats or flags_obj.profile_steps
+    steps_per_loop = 1 if per_step else max(min(flags_obj.steps_per_loop, steps_per_epoch), 1)
+    optimizer = model.optimizer
+    loss_fn = self._create_loss_fn(params)
+    use_loss_scale = isinstance(optimizer, tf.compat.v2.keras.mixed_precision.experimental.LossScaleOptimizer)
+
+    # the schedule of model.fit; its learning rates of a loop are computed in python and fed to train_steps
+    learning_rate_fn = self._create_learning_rate_fn(params)
+    # same step numbering as optimizer.LearningRateScheduler, which counts from current_step
+    schedule_step = current_step
+
+    with strategy.scope():
+      train_loss = tf.keras.metrics.Mean('loss', dtype=tf.float32)
+
+    def _compute_loss(batch):
+      (inputs, targets), labels = batch
+      loss = loss_fn(labels, model([inputs, targets], training=True))
+      train_loss.update_state(loss)
+      scaled_loss = loss / strategy.num_replicas_in_sync
+      return optimizer.get_scaled_loss(scaled_loss) if use_loss_scale else scaled_loss
+
+    def _compute_gradients(batch):
+      if flags_obj.grad_accum_steps > 1:
+        _, grads = utils.accumulate_gradients(_compute_loss, batch, flags_obj.grad_accum_steps, model.trainable_variables)
+      else:
+        with tf.GradientTape() as tape:
+          scaled_loss = _compute_loss(batch)
+        grads = tape.gradient(scaled_loss, model.trainable_variables)
+      return grads
+
+    if flags_obj.enable_xla:
+      # forward and backward pass are compiled (and fused) by XLA once per input shape;
+      # the gradient all-reduce and update run outside of the cluster
+      _compute_gradients = self._jit_function(_compute_gradients)
+
+    def _replica_step(batch):
+      grads = _compute_gradients(batch)
+      if use_loss_scale:
+        grads = optimizer.get_unscaled_gradients(grads)
+      optimizer.apply_gradients(zip(grads, model.trainable_variables))
+
+    num_traces = [0]
+    # strategy.run is experimental_run_v2 before TF 2.2
+    run = getattr(strategy, 'run', None) or strategy.experimental_run_v2
+
+    @tf.function
+    def train_steps(iterator, num_steps, learning_rates):
+      num_traces[0] += 1  # python code only runs when the function is traced
+      for idx in tf.range(num_steps):
+        optimizer.lr.assign(learning_rates[idx])
+        run(_replica_step, args=(next(iterator),))
+
+    if train_iterator is not None:
+      iterator = train_iterator  # keeps the checkpointed input position
+    else:
+      iterator = iter(strategy.experimental_distribute_dataset(train_ds))
+
+    history = tf.keras.callbacks.History()
+    callbacks = tf.keras.callbacks.CallbackList(
+        [history] + self._create_callbacks(log_dir, current_step, steps_per_epoch, params, ckpt_mgr,
+                                           interim_ckpt_mgr=interim_ckpt_mgr, use_ctl=True))
+    callbacks.set_model(model)
+    interim_checkpoint = next(cb for cb in callbacks.callbacks if isinstance(cb, utils.InterimCheckpoint))
+    compile_monitor = next((cb for cb in callbacks.callbacks if isinstance(cb, utils.CompileMonitor)), None)
+    step_callbacks = [cb for cb in callbacks.callbacks if isinstance(cb, (utils.StepStats, utils.ProfilerCallback))]
+    summary_writers = {name: tf.summary.create_file_writer(os.path.join(log_dir, name)) for name in ['train', 'validation']}
+    validation_steps = flags_obj.validation_example_count // params["batch_size"]
+
+    model.stop_training = False
+    callbacks.on_train_begin()
+    step = current_step
+    for epoch in range(current_step // steps_per_epoch, (flags_obj.train_steps-1) // steps_per_epoch + 1):
+      train_loss.reset_states()
+      epoch_end_step = min((epoch + 1) * steps_per_epoch, flags_obj.train_steps)
+      start_time = time.time()
+      while step < epoch_end_step:
+        num_steps = min(steps_per_loop, epoch_end_step - step)
+        traced = num_traces[0]
+        for cb in step_callbacks:
+          cb.on_train_batch_begin(step)
+        # always steps_per_loop learning rates, so a shorter last loop doesn't retrace train_steps
+        learning_rates = [learning_rate_fn(schedule_step + idx + 1) for idx in range(steps_per_loop)]
+        train_steps(iterator, tf.constant(num_steps), tf.constant(learning_rates, tf.float32))
+        schedule_step += num_steps
+        for cb in step_callbacks:
+          cb.on_train_batch_end(step)
+        if compile_monitor is not None:
+          compile_monitor.record(step + num_steps, time.time() - start_time)
+        if num_traces[0] > traced > 0:
+          logging.warning(f'train_steps is retraced (#{num_traces[0]}), its input signature changed')
+        step += num_steps
+        loss, lr = float(train_loss.result()), float(optimizer.lr.numpy())
+        logging.info(f'step {step}: loss = {loss:.4f}, lr = {lr:.6f}, {num_steps / (time.time() - start_time):.2f} steps/s')
+        start_time = time.time()
+        if self.flags_obj.enable_tensorboard:
+          with summary_writers['train'].as_default():
+            tf.summary.scalar('batch_loss', loss, step=step)
+            tf.summary.scalar('learning_rate', lr, step=step)
+        if interim_checkpoint.after_steps(num_steps):
+          break
+      if model.stop_training:
+        break
+
+      logs = {'loss': float(train_loss.result())}
+      # a scalar or list rather than return_dict=True, which needs TF 2.2+
+      val_res = model.evaluate(val_ds, steps=validation_steps, verbose=0)
+      val_logs = dict(zip(model.metrics_names, np.atleast_1d(val_res).tolist()))
+      logs.update({'val_' + name: value for name, value in val_logs.items()})
+      logs['lr'], logs['steps'] = float(optimizer.lr.numpy()), step
+      if self.flags_obj.enable_tensorboard:
+        with summary_writers['train'].as_default():
+          tf.summary.scalar('epoch_loss', logs['loss'], step=epoch)
+        with summary_writers['validation'].as_default():
+          for name, value in val_logs.items():
+            tf.summary.scalar('epoch_' + name, value, step=epoch)
+      callbacks.on_epoch_end(epoch, logs)
+    callbacks.on_train_end()
+    return history
+
   def eval(self):
     """Evaluates the model."""
     with distribution_utils.get_strategy_scope(self.distribution_strategy):
       model = self.create_model(mode='eval')
-      model.compile(loss=self._create_loss_fn(self.params))
+      model.compile(loss=self._create_loss_fn(self.params), **self._jit_compile_args())
       model.summary()
       self._load_model_weights(model)
 
@@ -186,8 +456,122 @@ class Seq2SeqTask():
     ds = self._create_dataset(self.params['data_dir'], repeat=1).take(N)
     res = model.evaluate(ds, steps=N)
     logging.info('Evaluate {} batches, res={}'.format(N, res))
+    # e.g. for make compare-dtype
+    with open(os.path.join(self.flags_obj.model_dir, 'eval-result.json'), 'w') as f:
+      json.dump(dict(zip(model.metrics_names, np.atleast_1d(res).tolist()), dtype=self.flags_obj.dtype, batches=N), f)
+
+  def eval_sweep(self):
+    """Evaluates the Reformer with every one of --eval_sweep_settings in one process.
+
+    The model is built and its weights are restored once, and the validation
+    batches are read once and cached in memory, so every setting sees exactly
+    the same batches. A setting is a test_num_hashes value of the LSH attention
+    layers, or 'full' for use_full_attention_in_reformer. The comparison table
+    is logged and written to model_dir/eval-sweep.tsv.
+    """
+    params, flags_obj = self.params, self.flags_obj
+    if not flags_obj.eval_sweep_settings:
+      raise ValueError('--mode=eval-sweep requires at least one of --eval_sweep_settings')
+    with distribution_utils.get_strategy_scope(self.distribution_strategy):
+      model = self.create_model(mode='eval')
+      self._load_model_weights(model)
+    lsh_layers = [layer for layer in model.submodules if isinstance(layer, attention_layer.LshSelfAttention)]
+    if not lsh_layers:
+      raise ValueError('--mode=eval-sweep requires --use_reformer, the model has no LSH attention layers')
+
+    N = flags_obj.validation_example_count // params["batch_size"]
+    ds = self._create_dataset(params['data_dir'], repeat=1).take(N).cache()
+    # a full pass fills the in-memory cache; tf.data drops a cache that isn't read to the end
+    for _ in ds:
+      pass
+
+    rows = []
+    for setting in flags_obj.eval_sweep_settings:
+      for layer in lsh_layers:
+        layer.use_full_attention_in_reformer = setting == 'full'
+        if setting != 'full':
+          layer.test_num_hashes = int(setting)
+      # the settings are python values of the traced test function; compiling again drops it, so
+      # evaluate retraces it (model.test_function = None only does so from TF 2.2 on)
+      with distribution_utils.get_strategy_scope(self.distribution_strategy):
+        model.compile(loss=self._create_loss_fn(params), **self._jit_compile_args())
+      start_time = time.time()
+      # no steps, so every evaluate reads the cached dataset to the end;
+      # a scalar or list rather than return_dict=True, which needs TF 2.2+
+      res = model.evaluate(ds, verbose=0)
+      res = dict(zip(model.metrics_names, np.atleast_1d(res).tolist()))
+      seconds = time.time() - start_time
+      logging.info(f'eval-sweep {setting}: {res}, {seconds:.1f}s')
+      rows.append([setting] + [f'{res[name]:.5f}' for name in sorted(res)] + [f'{seconds:.1f}'])
+
+    header = ['setting'] + sorted(res) + ['seconds']
+    table = '\n'.join('\t'.join(row) for row in [header] + rows)
+    with open(os.path.join(flags_obj.model_dir, 'eval-sweep.tsv'), 'w') as f:
+      f.write(table + '\n')
+    logging.info(f'eval-sweep of {N} batches of {params["data_dir"]}:\n{table}')
+
+  def eval_watch(self):
+    """Decodes a fixed slice of data_dir with every new checkpoint in model_dir.
+
+    Runs as a separate process next to the trainer, which it never blocks: the
+    predict model is built once, and the weights of each new checkpoint are
+    swapped in. Exact match accuracy (and ROUGE scores with --calc_rouge_scores)
+    of max_predict_count examples are written to TensorBoard (model_dir/eval_watch)
+    at the training step of the checkpoint. Stops when no new checkpoint comes
+    within eval_watch_timeout_secs.
+    """
+    params, flags_obj = self.params, self.flags_obj
+    with distribution_utils.get_strategy_scope(self.distribution_strategy):
+      model = self.create_model(mode='predict')
+      model.summary()
+      if flags_obj.enable_xla:
+        model.compile(**self._jit_compile_args())
+    checkpoint = tf.train.Checkpoint(model=model)
+
+    example_count = flags_obj.max_predict_count or flags_obj.validation_example_count
+    inputs, target_strings = [], []
+    # untrimmed, so the rows can be stacked; with --length_buckets the batches are trimmed below
+    for ((inp, tar), _) in self._create_dataset(params['data_dir'], repeat=1, batch_size=1, trim=False).unbatch().take(example_count):
+      inputs.append(inp.numpy())
+      target_strings.append([self._trim_and_decode(tar.numpy())])
+    # full batches only, so the predict function is traced (compiled) once for all checkpoints
+    X = np.vstack(inputs + [inputs[0]] * (-len(inputs) % params['batch_size']))
+    Y = np.ones([len(X), 1], np.int32)
+    pred_input = [X, Y]
+    if flags_obj.length_buckets:
+      length_buckets = self._get_length_buckets()
+      pred_input = tf.data.Dataset.from_tensor_slices((X, Y)).batch(params['batch_size'])
+      pred_input = pred_input.map(lambda x, y: ((self._trim_batch(x, length_buckets), y),))
+    logging.info(f'decode {len(inputs)} examples of {params["data_dir"]} with every checkpoint')
+
+    summary_writer = tf.summary.create_file_writer(os.path.join(flags_obj.model_dir, 'eval_watch'))
+    for checkpoint_path in tf.train.checkpoints_iterator(flags_obj.model_dir, min_interval_secs=flags_obj.eval_watch_interval_secs,
+                                                         timeout=flags_obj.eval_watch_timeout_secs or None):
+      try:
+        step = self._checkpoint_step(checkpoint_path)
+        checkpoint.restore(checkpoint_path).expect_partial()
+      except (tf.errors.NotFoundError, tf.errors.DataLossError):
+        # deleted by the trainer's CheckpointManager (max_to_keep) before it's evaluated
+        logging.warning(f'can\'t read {checkpoint_path}, skip it')
+        continue
+
+      start_time = time.time()
+      preds = model.predict(pred_input, batch_size=None if flags_obj.length_buckets else params['batch_size'])[0][:len(inputs)]
+      pred_strings = [self._trim_and_decode(ids) for ids in preds]
+      results = {'exact_match': sum(pred == ref[0] for pred, ref in zip(pred_strings, target_strings)) / len(inputs)}
+      if flags_obj.calc_rouge_scores:
+        scores = self._calculate_rouge_scores(pred_strings, target_strings)
+        results.update({f'rouge_{n}_f': scores[f'ROUGE-{n}-F'] for n in ['1', '2', 'L']})
+      logging.info(f'{checkpoint_path} (step {step}): {results}, decoded in {time.time() - start_time:.1f}s')
+      with summary_writer.as_default():
+        for name, value in results.items():
+          tf.summary.scalar(f'eval_watch/{name}', value, step=step)
+      summary_writer.flush()
+    logging.info(f'no new checkpoint in {flags_obj.eval_watch_timeout_secs}s, stop evaluating')
 
   _UNDERSCORE_REPLACEMENT = "\\&undsc"
+  _MAX_INPUT_SEGMENTS = 10  # <BOS#i>/<EOS#i> markers reserved in vocab
+  _PARSE_BATCH_SIZE = 256  # number of serialized records parsed by one vectorized map call
 
   def _decode_and_fix(self, ids):
     return self.tokenizer.decode(ids).replace(self._UNDERSCORE_REPLACEMENT, '_')
@@ -239,10 +623,13 @@ class Seq2SeqTask():
       model = self.create_model(mode='predict')
       model.summary()
       self._load_model_weights(model)
+      if flags_obj.enable_xla:
+        model.compile(**self._jit_compile_args())
 
     np.set_printoptions(threshold=sys.maxsize)
 
-    ds = self._create_dataset(params['data_dir'], repeat=1, batch_size=1)
+    # untrimmed, the stacked inputs are trimmed batch by batch below
+    ds = self._create_dataset(params['data_dir'], repeat=1, batch_size=1, trim=False)
     logging.info('max prediction limit = {}'.format(flags_obj.max_predict_count))
     if flags_obj.max_predict_count:
       ds = ds.take(flags_obj.max_predict_count)
@@ -270,12 +657,27 @@ class Seq2SeqTask():
     if len(inputs) < 128 and params['num_gpus'] > 1:
       inputs += [inputs[0]] * (128 - original_inputs_len)
       logging.info(f'len(inputs)={original_inputs_len}, append inputs to {len(inputs)}')
+    if flags_obj.enable_xla and len(inputs) % params['batch_size']:
+      # the last batch is full too, so predict is compiled for one batch shape
+      inputs += [inputs[0]] * (params['batch_size'] - len(inputs) % params['batch_size'])
     X = np.vstack(inputs)
     Y = np.ones([len(inputs), 1], np.int32)
     logging.info(f'load {len(targets)} examples from {params["data_dir"]}, ignore {ignored_count} examples')
 
     correct, total = 0, 0
-    mpred = model.predict([X, Y], batch_size=params['batch_size'], verbose=1 if flags_obj.dev_mode else 0)
+    predict_callbacks = [utils.ProfilerCallback(flags_obj.model_dir, flags_obj.profile_steps, 'predict')] if flags_obj.profile_steps else None
+    predict_start = time.time()
+    if flags_obj.length_buckets:
+      length_buckets = self._get_length_buckets()
+      pred_ds = tf.data.Dataset.from_tensor_slices((X, Y)).batch(params['batch_size'], drop_remainder=flags_obj.enable_xla)
+      pred_ds = pred_ds.map(lambda x, y: ((self._trim_batch(x, length_buckets), y),))
+      mpred = model.predict(pred_ds, verbose=1 if flags_obj.dev_mode else 0, callbacks=predict_callbacks)
+    else:
+      mpred = model.predict([X, Y], batch_size=params['batch_size'], verbose=1 if flags_obj.dev_mode else 0, callbacks=predict_callbacks)
+    logging.info(f'predict {len(inputs)} examples in {time.time() - predict_start:.1f}s (including trace and compile)')
+    predict_function = getattr(model, 'predict_function', None)
+    if hasattr(predict_function, 'experimental_get_tracing_count') and predict_function.experimental_get_tracing_count() > 1:
+      logging.warning(f'the predict function was traced {predict_function.experimental_get_tracing_count()} times')
     for ind, (pred_ids, score, logits) in enumerate(zip(*mpred)):
       if original_inputs_len and original_inputs_len == ind: break
       preds.append(pred_ids)
@@ -424,32 +826,102 @@ class Seq2SeqTask():
             f.write(f'_HtmlBody    = {getattr(inp, "HtmlBody")}\n')
       logging.info('write prediction details to {}'.format(out_path))
 
-  def _create_callbacks(self, log_dir, init_steps, steps_per_epoch, params, ckpt_mgr):
-    """Creates a list of callbacks."""
-    sfunc = optimizer.LearningRateFn(params["learning_rate"],
-                                     params["hidden_size"],
-                                     params["learning_rate_warmup_steps"])
+  def _create_callbacks(self, log_dir, init_steps, steps_per_epoch, params, ckpt_mgr, interim_ckpt_mgr=None, use_ctl=False):
+    """Creates a list of callbacks.
+
+    With use_ctl, the custom training loop sets the learning rate and writes
+    TensorBoard logs itself, so only checkpoint and CSV callbacks are created.
+    """
+    sfunc = self._create_learning_rate_fn(params)
+
+    checkpoint_options = self._create_checkpoint_options()
 
     def _save_checkpoint(epoch, logs):
       if logs['steps'] % steps_per_epoch == 0:
         try:
-          ckpt_mgr.save(checkpoint_number=epoch)
-        except:
-          logging.warning(f'save model failed due to an exception. continue without saving\n')
+          utils.save_checkpoint(ckpt_mgr, epoch, checkpoint_options)
+        except Exception:
+          logging.exception(f'save checkpoint of epoch {epoch} (step {logs["steps"]}) failed')
+          raise
       else:
-        logging.warning(f'not save model when training is interrupted. logs = {logs}\n')
+        logging.warning(f'not save an epoch checkpoint for the interrupted epoch {epoch}. logs = {logs}\n')
 
     callbacks = []
-    callbacks.append(optimizer.LearningRateScheduler(sfunc, init_steps))
+    if not use_ctl:
+      callbacks.append(optimizer.LearningRateScheduler(sfunc, init_steps))
     callbacks.append(tf.keras.callbacks.LambdaCallback(on_epoch_end=_save_checkpoint))
-    if self.flags_obj.enable_tensorboard:
+    if interim_ckpt_mgr is not None:
+      callbacks.append(utils.InterimCheckpoint(interim_ckpt_mgr, init_steps,
+          every_n_steps=self.flags_obj.checkpoint_interval_steps,
+          every_n_secs=self.flags_obj.checkpoint_interval_secs,
+          options=checkpoint_options))
+    if self.flags_obj.enable_tensorboard and not use_ctl:
       tensorboard_callback = utils.TensorBoardFix(start_step=init_steps,
           log_dir=log_dir, profile_batch=0, write_graph=False,
           update_freq=self.flags_obj.batches_between_tensorboard_log)
       callbacks.append(tensorboard_callback)
+    if self.flags_obj.enable_xla:
+      callbacks.append(utils.CompileMonitor(max_compiles=self._num_input_shapes()))
+    if self._train_profiler is not None:
+      callbacks.append(self._train_profiler)
+    if self.flags_obj.enable_step_stats:
+      # before CSVLoggerFix, which writes the stats added to the epoch logs
+      summary_writer = tf.summary.create_file_writer(os.path.join(log_dir, 'step_stats')) if self.flags_obj.enable_tensorboard else None
+      callbacks.append(utils.StepStats(log_dir, init_steps, self._batch_handovers,
+          window=self.flags_obj.step_stats_window, summary_writer=summary_writer))
     callbacks.append(utils.CSVLoggerFix(f'{log_dir}/history.step-{init_steps}.log'))
     return callbacks
 
+  def _num_input_shapes(self):
+    """Number of distinct input shapes of training batches, i.e. of XLA compiles of the train step."""
+    return len(self._get_length_buckets()) if self.flags_obj.length_buckets else 1
+
+  def _jit_compile_args(self):
+    """Returns the model.compile arguments, which compile the train/predict functions with XLA if --enable_xla.
+
+    model.compile takes jit_compile from TF 2.5 on; older TF auto-clusters
+    the functions for XLA by tf.config.optimizer.set_jit instead.
+    """
+    if not self.flags_obj.enable_xla:
+      return {}
+    if 'jit_compile' in inspect.signature(tf.keras.Model.compile).parameters:
+      logging.info('XLA: model.compile(jit_compile=True)')
+      return {'jit_compile': True}
+    logging.info('XLA: tf.config.optimizer.set_jit(True), model.compile has no jit_compile before TF 2.5')
+    tf.config.optimizer.set_jit(True)
+    return {}
+
+  @staticmethod
+  def _jit_function(fn):
+    """Returns tf.function(fn) compiled by XLA, by experimental_compile before TF 2.5."""
+    if 'jit_compile' in inspect.signature(tf.function).parameters:
+      logging.info('XLA: tf.function(jit_compile=True)')
+      return tf.function(fn, jit_compile=True)
+    logging.info('XLA: tf.function(experimental_compile=True), jit_compile needs TF 2.5+')
+    return tf.function(fn, experimental_compile=True)
+
+  def _create_learning_rate_fn(self, params):
+    """Returns the learning rate schedule, a function of the (1-based) training step."""
+    return optimizer.LearningRateFn(params["learning_rate"],
+                                    params["hidden_size"],
+                                    params["learning_rate_warmup_steps"])
+
+  def _create_checkpoint_options(self):
+    """Returns the CheckpointOptions of saves, which write in the background with --async_checkpoint.
+
+    An async save copies the variables to host memory and returns, the files are
+    written by a background thread while training continues (TF 2.11+).
+    """
+    if not self.flags_obj.async_checkpoint:
+      return None
+    try:
+      # old TF (e.g. 2.1) has no tf.train.CheckpointOptions, TF < 2.11 has no experimental_enable_async_checkpoint
+      return tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+    except (AttributeError, TypeError):
+      logging.warning(f'--async_checkpoint has no effect on TF {tf.__version__}, which has no async checkpoint '
+                      f'(TF 2.11+): training pauses while every checkpoint is written')
+      return None
+
   def _load_model_weights(self, model):
     checkpoint = tf.train.Checkpoint(model=model)
     checkpoint_path = tf.train.latest_checkpoint(self.flags_obj.model_dir)
@@ -468,17 +940,51 @@ class Seq2SeqTask():
 
   def _create_loss_fn(self, params):
     logging.info('use loss_fn: %s', self.flags_obj.loss_fn)
+    if params.get("logits_chunk_size"):
+      if self.flags_obj.loss_fn != 'smoothed_cross_entropy':
+        raise ValueError(f'--logits_chunk_size computes the smoothed cross entropy in the model, '
+                         f'set --loss_fn=smoothed_cross_entropy (not {self.flags_obj.loss_fn}) or --logits_chunk_size=0')
+      def chunked_loss(y_true, y_pred):
+        # y_pred is the weighted cross entropy of every position, see metrics.chunked_padded_cross_entropy_loss
+        batch_size = tf.shape(y_pred)[0]
+        weights = tf.cast(tf.not_equal(tf.reshape(y_true, [batch_size, -1]), 0), tf.float32)
+        return tf.reduce_sum(y_pred) / tf.reduce_sum(weights)
+      return chunked_loss
     if self.flags_obj.loss_fn == 'smoothed_cross_entropy':
       label_smoothing = params["label_smoothing"]
       vocab_size = params["vocab_size"]
       def loss(y_true, y_pred):
-        y_true = tf.reshape(y_true, [params['batch_size'], -1])
-        y_pred = tf.reshape(y_pred, [params['batch_size'], -1, vocab_size])
+        # the per-replica batch, which is smaller than params['batch_size'] with a distribution strategy
+        batch_size = tf.shape(y_pred)[0]
+        y_true = tf.reshape(y_true, [batch_size, -1])
+        y_pred = tf.reshape(y_pred, [batch_size, -1, vocab_size])
         return metrics.transformer_loss(y_pred, y_true, label_smoothing, vocab_size)
       return loss
     else:
       return tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
 
+  def _group_micro_batches(self, ds, num_micro_batches):
+    """Stacks every num_micro_batches batches of ds along axis 1, for utils.accumulate_gradients."""
+    ds = ds.padded_batch(num_micro_batches, drop_remainder=True)
+    return ds.map(lambda x, y: tf.nest.map_structure(lambda t: tf.transpose(t, [1, 0, 2]), (x, y)))
+
+  def _get_length_buckets(self):
+    """Returns the sorted lengths that input batches are trimmed to, the last one is max_input_length."""
+    max_input_length = self.params['max_input_length']
+    buckets = [int(v) for v in self.flags_obj.length_buckets.split(',')] if self.flags_obj.length_buckets else []
+    if self.flags_obj.use_reformer:
+      # LSH attention hashes a sequence into an even number of buckets of bucket_size
+      unit = 2 * self.params['bucket_size']
+      buckets = [(b + unit - 1) // unit * unit for b in buckets]
+    return sorted(set(b for b in buckets if 0 < b < max_input_length)) + [max_input_length]
+
+  def _trim_batch(self, inputs, length_buckets):
+    """Trims a padded batch of inputs to the smallest length bucket that holds its last non-pad token."""
+    positions = tf.range(1, tf.shape(inputs)[1] + 1)
+    length = tf.reduce_max(tf.where(tf.not_equal(inputs, 0), positions, 0))
+    length_buckets = tf.constant(length_buckets, tf.int32)
+    return inputs[:, :tf.gather(length_buckets, tf.searchsorted(length_buckets, [length]))[0]]
+
   def _create_random_dataset(self, vocab_size, batch_size, max_input_length, max_target_length):
     def _random_example_generator():
       while True:
@@ -491,7 +997,7 @@ class Seq2SeqTask():
                                         output_shapes=((batch_size, max_input_length), (batch_size, max_target_length)))
     return ds
 
-  def _create_dtitle_dataset(self, data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos):
+  def _create_dtitle_dataset(self, records, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos):
     def _dtitle_encode(ln):
       url, tar, hostname, html = tf.strings.split(ln, '\t')
 
@@ -521,29 +1027,36 @@ class Seq2SeqTask():
         hostname = hostname[:hostname_segment_limit - 1] + [eos] + [0] * max(0, hostname_segment_limit - 1 - len(hostname))
         html = html[:html_segment_limit-1] + [eos]
         return url + hostname + html, tar + [eos]
+      elif self.flags_obj.input_concat_schema == 'v4':
+        # packed (no padding), segments end with <EOS#i>, the model adds segment embeddings
+        url = url[:url_segment_limit - 1] + [eos+11]
+        hostname = hostname[:hostname_segment_limit - 1] + [eos+12]
+        html = html[:html_segment_limit - 1] + [eos+13]
+        return (url + hostname + html)[:max_input_length], tar + [eos]
       else:
         raise ValueError('invalid input_concat_schema: ' + self.flags_obj.input_concat_schema)
 
-    ds = tf.data.TextLineDataset(data_file, compression_type='GZIP' if data_file.endswith('.gz') else None)
-    ds = ds.map(lambda ln: tf.py_function(_dtitle_encode, [ln], [tf.int32, tf.int32]), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = records.map(lambda ln: tf.py_function(_dtitle_encode, [ln], [tf.int32, tf.int32]), num_parallel_calls=self.params["num_parallel_calls"])
     ds = ds.filter(lambda _, target: tf.size(target) <= max_target_length)
     ds = ds.padded_batch(batch_size, padded_shapes=([max_input_length], [max_target_length]), drop_remainder=True)
     return ds
 
-  def _create_tfrecord_dataset(self, data_file, batch_size, max_input_length, max_target_length):
+  def _create_tfrecord_dataset(self, records, batch_size, max_input_length, max_target_length):
     def _convert_proto_to_tensor(proto):
       X = tf.reshape(tf.io.parse_tensor(proto, tf.int32), shape=[-1, max_input_length + max_target_length])
       return X[:, :max_input_length], X[:, max_input_length:]
 
-    ds = tf.data.TFRecordDataset(data_file, compression_type='GZIP' if data_file.endswith('.gz') else None)
-    ds = ds.map(_convert_proto_to_tensor, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = records.map(_convert_proto_to_tensor, num_parallel_calls=self.params["num_parallel_calls"])
     ds = ds.unbatch().batch(batch_size, drop_remainder=True)
     return ds
 
   def _create_description_from_names(self, names):
       return {col: tf.io.FixedLenSequenceFeature([], tf.int64, allow_missing=True) for col in names}
 
-  def _create_tokenized_tfrecord_dataset(self, data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos):
+  def _create_ragged_description_from_names(self, names):
+      return {col: tf.io.RaggedFeature(tf.int64, row_splits_dtype=tf.int64) for col in names}
+
+  def _create_tokenized_tfrecord_dataset(self, records, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos):
     description = self._create_description_from_names(['url', 'title', 'hostname', 'html'])
     def _tf_parse_and_truncate_v2(proto):
       ex = tf.io.parse_single_example(proto, description)
@@ -552,8 +1065,7 @@ class Seq2SeqTask():
              tf.concat([[eos+3], tf.cast(ex['html'][:html_segment_limit-2], tf.int32), [eos]], axis=0),
              tf.concat([tf.cast(ex['title'], tf.int32), [eos]], axis=0) ]
 
-    ds = tf.data.TFRecordDataset(data_file, compression_type='GZIP' if data_file.endswith('.gz') else None)
-    ds = ds.map(_tf_parse_and_truncate_v2, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = records.map(_tf_parse_and_truncate_v2, num_parallel_calls=self.params["num_parallel_calls"])
     ds = ds.filter(lambda _a, _b, _c, target: tf.size(target) <= max_target_length)
     ds = ds.padded_batch(batch_size, padded_shapes=([url_segment_limit], [hostname_segment_limit], [html_segment_limit], [max_target_length]), drop_remainder=True)
     ds = ds.map(lambda url, hostname, html, title: (tf.concat([url, hostname, html], axis=-1), title))
@@ -565,22 +1077,39 @@ class Seq2SeqTask():
     #targets_and_limits = [(v[0], int(v[1])) for v in [col.split(':') for col in target_schema.split(',')]]
     return inputs_and_limits, target_schema#targets_and_limits
 
-  def _create_dtitle_tokenized_dataset(self, data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos):
-    description = self._create_description_from_names(self.flags_obj.dtitle_data_schema.split(','))
+  def _truncate_and_pad_columns(self, ex, max_input_length, max_target_length, eos):
+    """Truncates/concats/pads a batch of ragged token columns {name: [rows, None]} with ragged ops.
 
+    Returns dense (inputs, targets) of the rows whose target fits in max_target_length.
+    """
     names_limits, target_schema = self._get_training_schema()
+    packed = self.flags_obj.input_concat_schema == 'v4'
 
-    def _tf_parse_and_truncate_v3(proto):
-      def _cast_and_concat(*values):
-        return tf.concat([tf.cast(t, tf.int32) for t in values], axis=0)
+    def _fill(value):
+      return tf.RaggedTensor.from_tensor(tf.fill([ex[target_schema].nrows(), 1], value))
 
-      ex = tf.io.parse_single_example(proto, description)
-      inputs = tf.concat([_cast_and_concat([eos+idx+1], ex[name][:limit-2], [eos+idx+11]) for idx, (name, limit) in enumerate(names_limits)], axis=0)
-      target = _cast_and_concat(ex[target_schema], [eos])
-      return inputs[:max_input_length], target
+    segments = []
+    for idx, (name, limit) in enumerate(names_limits):
+      if packed:
+        # v4: no <BOS#i>, so every segment keeps one more token
+        segments += [tf.cast(ex[name][:, :limit-1], tf.int32), _fill(eos+idx+11)]
+      else:
+        segments += [_fill(eos+idx+1), tf.cast(ex[name][:, :limit-2], tf.int32), _fill(eos+idx+11)]
+    inputs = tf.concat(segments, axis=1)[:, :max_input_length]
+    target = tf.concat([tf.cast(ex[target_schema], tf.int32), _fill(eos)], axis=1)
+
+    valid = target.row_lengths() <= max_target_length
+    inputs = tf.ragged.boolean_mask(inputs, valid)
+    target = tf.ragged.boolean_mask(target, valid)
+    return inputs.to_tensor(shape=[None, max_input_length]), target.to_tensor(shape=[None, max_target_length])
 
-    def _filter_fn(inp, tar):
-      return tf.size(tar) <= max_target_length
+  def _create_dtitle_tokenized_dataset(self, records, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos):
+    description = self._create_ragged_description_from_names(self.flags_obj.dtitle_data_schema.split(','))
+
+    def _tf_parse_and_truncate_batch(protos):
+      """Parse a batch of serialized examples, then truncate/concat/pad columns with ragged ops."""
+      ex = tf.io.parse_example(protos, description)
+      return self._truncate_and_pad_columns(ex, max_input_length, max_target_length, eos)
 
     #r = tf.random.uniform(shape=[])
     #positive, negative = tf.Variable(0, dtype=tf.int64), tf.Variable(0, dtype=tf.int64)
@@ -596,13 +1125,153 @@ class Seq2SeqTask():
     #    else:
     #      return False
 
-    ds = tf.data.TFRecordDataset(data_file, compression_type='GZIP' if data_file.endswith('.gz') else None)
-    ds = ds.map(_tf_parse_and_truncate_v3, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-    ds = ds.filter(_filter_fn)
-    ds = ds.padded_batch(batch_size, padded_shapes=([max_input_length], [max_target_length]), drop_remainder=True)
+    # parse in large batches to amortize op dispatch, then rebatch the dense (already padded) rows
+    # to exactly batch_size, since filtering may drop a few rows from each parsed batch.
+    ds = records.batch(max(batch_size, self._PARSE_BATCH_SIZE))
+    ds = ds.map(_tf_parse_and_truncate_batch, num_parallel_calls=self.params["num_parallel_calls"])
+    ds = ds.unbatch().batch(batch_size, drop_remainder=True)
+    return ds
+
+  def _create_dtitle_mmap_dataset(self, data_dir, batch_size, max_input_length, max_target_length, eos, shuffle=False, input_shard=None):
+    """Reads the columns of a .dtitle.mmap store (process_dtitle_data.py --cmd=convert-to-mmap).
+
+    Every column is a flat uint16 token array plus int64 row offsets, both
+    memory-mapped .npy files, so a batch of rows is two slices of the mapped
+    memory; no decompression or proto parsing. With shuffle, the order of the
+    row blocks is shuffled globally, which costs no buffer memory. With
+    input_shard = (num_shards, index), only the index-th shard of the row
+    blocks is read.
+    """
+    names_limits, target_schema = self._get_training_schema()
+    columns = [name for name, _ in names_limits] + [target_schema]
+    store = {col: (np.load(os.path.join(data_dir, f'{col}.ids.npy'), mmap_mode='r'),
+                   np.load(os.path.join(data_dir, f'{col}.offsets.npy'), mmap_mode='r')) for col in columns}
+    num_rows = len(store[target_schema][1]) - 1
+    block_size = max(batch_size, self._PARSE_BATCH_SIZE)
+    logging.info(f'open {num_rows} rows of columns {columns} from {data_dir}')
+
+    def _read_rows(start):
+      end = min(start + block_size, num_rows)
+      values_and_splits = []
+      for col in columns:
+        ids, offsets = store[col]
+        row_offsets = offsets[start:end + 1]
+        values_and_splits += [np.asarray(ids[row_offsets[0]:row_offsets[-1]]), row_offsets - row_offsets[0]]
+      return values_and_splits
+
+    def _read_and_truncate_batch(start):
+      values_and_splits = tf.numpy_function(_read_rows, [start], [tf.uint16, tf.int64] * len(columns))
+      values_and_splits = [tf.ensure_shape(t, [None]) for t in values_and_splits]
+      ex = {col: tf.RaggedTensor.from_row_splits(tf.cast(values_and_splits[2*idx], tf.int32), values_and_splits[2*idx+1], validate=False)
+            for idx, col in enumerate(columns)}
+      return self._truncate_and_pad_columns(ex, max_input_length, max_target_length, eos)
+
+    ds = tf.data.Dataset.range(0, num_rows, block_size)
+    if input_shard is not None:
+      # by block offsets, so the other shards' rows are never read
+      ds = ds.shard(*input_shard)
+    if shuffle:
+      ds = ds.shuffle(len(range(0, num_rows, block_size)))
+    ds = ds.map(_read_and_truncate_batch, num_parallel_calls=self.params["num_parallel_calls"])
+    ds = ds.unbatch().batch(batch_size, drop_remainder=True)
     return ds
 
-  def _create_dataset(self, data_file, repeat, batch_size=None, shuffle_size=None, create_cache=False):
+  def _create_record_dataset(self, data_file, record_dataset_cls, shard_by_hint=False, shuffle_memory_mb=None, input_shard=None):
+    """Opens the raw records (text lines or tfrecords) of data_file, which may be a glob.
+
+    With shard_by_hint, every tf.data service worker keeps a disjoint 1/N of the
+    records before they are parsed. With input_shard = (num_shards, index), only
+    the index-th shard of the files (or of the records if there are fewer files
+    than shards) is read. With shuffle_memory_mb, records are shuffled by
+    _shuffle_records within that memory budget.
+    """
+    files = sorted(tf.io.gfile.glob(data_file)) or [data_file]
+    compression_type = 'GZIP' if data_file.endswith('.gz') else None
+    shard_records = input_shard is not None and len(files) < input_shard[0]
+    if input_shard is not None and not shard_records:
+      files = files[input_shard[1]::input_shard[0]]
+
+    def _open_file(file_index, filename):
+      ds = record_dataset_cls(filename, compression_type=compression_type)
+      if shard_by_hint:
+        ds = ds.shard(tf.data.experimental.SHARD_HINT, tf.data.experimental.SHARD_HINT)
+      if shard_records:
+        ds = ds.shard(*input_shard)
+      return ds
+
+    if not shuffle_memory_mb:
+      return _open_file(0, files if len(files) > 1 else files[0])
+    block_buffer, example_buffer = self._plan_shuffle(files, record_dataset_cls, compression_type, shuffle_memory_mb)
+    return self._shuffle_records(files, _open_file, block_buffer, example_buffer)
+
+  def _plan_shuffle(self, files, record_dataset_cls, compression_type, shuffle_memory_mb):
+    """Splits shuffle_memory_mb between the block and example shuffle buffers, sized by a sample of records."""
+    sample = [len(r) for r in record_dataset_cls(files[0], compression_type=compression_type).take(1000).as_numpy_iterator()]
+    record_bytes = sum(sample) / max(len(sample), 1) or 1
+    budget_records = int(shuffle_memory_mb * 2**20 / record_bytes)
+    block_records = self.flags_obj.shuffle_block_records
+    block_buffer = max(budget_records // 2 // block_records, 1)
+    example_buffer = max(budget_records // 2, 1)
+    window = block_buffer * block_records * min(len(files), self._SHUFFLE_CYCLE_LENGTH) + example_buffer
+    logging.info(f'shuffle {len(files)} file(s) within {shuffle_memory_mb} MB (~{record_bytes:.0f} bytes/record): '
+                 f'{block_buffer} blocks of {block_records} records + {example_buffer} records buffered, '
+                 f'an example is drawn from a window of ~{window} records')
+    return block_buffer, example_buffer
+
+  _SHUFFLE_CYCLE_LENGTH = 16  # max number of files read concurrently when shuffling
+
+  def _shuffle_records(self, files, open_file, block_buffer, example_buffer):
+    """Shuffles records at file, block and example level, without a full-size buffer.
+
+    Files are read in a random order, several at a time; contiguous blocks of
+    records are shuffled in a buffer of block_buffer blocks, which moves records
+    across long distances cheaply, then an example_buffer mixes the records
+    inside and between neighbouring blocks. open_file(file_index, filename)
+    returns the records of one file.
+    """
+    if len(files) > 1:
+      ds = tf.data.Dataset.from_tensor_slices((tf.range(len(files), dtype=tf.int64), files)).shuffle(len(files))
+      ds = ds.interleave(open_file, cycle_length=min(len(files), self._SHUFFLE_CYCLE_LENGTH), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    else:
+      ds = open_file(tf.constant(0, tf.int64), files[0])
+    ds = ds.batch(self.flags_obj.shuffle_block_records).shuffle(block_buffer).unbatch()
+    return ds.shuffle(example_buffer)
+
+  def _report_shuffle_mixing(self, data_file, record_dataset_cls, shuffle_memory_mb, sample_size=100000):
+    """Measures how far the shuffled order of the first sample_size records is from the file order."""
+    files = sorted(tf.io.gfile.glob(data_file)) or [data_file]
+    compression_type = 'GZIP' if data_file.endswith('.gz') else None
+
+    def _open_indexes(file_index, filename):
+      ds = record_dataset_cls(filename, compression_type=compression_type).enumerate()
+      return ds.map(lambda idx, _: (file_index, idx))
+
+    block_buffer, example_buffer = self._plan_shuffle(files, record_dataset_cls, compression_type, shuffle_memory_mb)
+    ds = self._shuffle_records(files, _open_indexes, block_buffer, example_buffer)
+    file_indexes, record_indexes = next(ds.batch(sample_size).as_numpy_iterator())
+    count = len(record_indexes)
+    # spearman rank correlation between output position and record position in its file, 1 means file order
+    ranks = np.argsort(np.argsort(record_indexes, kind='stable'))
+    positions = np.arange(count)
+    rho = 1 - 6 * np.sum((ranks - positions) ** 2.0) / max(count * (count ** 2 - 1), 1)
+    displacement = np.median(np.abs(record_indexes - positions // len(files)))
+    logging.info(f'shuffle mixing of the first {count} records of {data_file}: rank correlation with file order = {rho:.3f} '
+                 f'(1: file order, ~0: well mixed), median displacement = {displacement:.0f} records, '
+                 f'{len(np.unique(file_indexes[:1000]))}/{len(files)} files in the first 1000 records')
+    return rho, displacement
+
+  def _create_dataset(self, data_file, repeat, batch_size=None, shuffle_memory_mb=None, create_cache=False, data_service=None, input_shard=None,
+                      trim=True):
+    """Creates the dataset of ((inputs, targets), targets) batches from data_file.
+
+    If shuffle_memory_mb is given, the records are shuffled before parsing, see
+    _shuffle_records. If data_service (a data_service.LocalDataService) is given,
+    the dataset is produced by its worker processes and streamed to this process.
+    If input_shard = (num_shards, index) is given, only that shard of the data is
+    read, and tf.distribute doesn't shard the dataset again.
+    With --length_buckets and trim, every batch is trimmed by _trim_batch; pass
+    trim=False to read examples of max_input_length, e.g. to stack them.
+    """
     batch_size = batch_size or self.params['batch_size']
     max_input_length = self.params['max_input_length']
     max_target_length = self.params['max_target_length']
@@ -615,27 +1284,47 @@ class Seq2SeqTask():
       ds = self._create_random_dataset(self.params["vocab_size"], batch_size, max_input_length, max_target_length)
     elif data_file.endswith('.dtitle') or data_file.endswith('.dtitle.gz'):
       logging.info(f'open one dtitle dataset from "{data_file}".')
-      ds = self._create_dtitle_dataset(data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, self.EOS_id)
+      if data_service:
+        raise ValueError(f'dtitle text dataset uses tf.py_function and can\'t be served by tf.data service: {data_file}')
+      records = self._create_record_dataset(data_file, tf.data.TextLineDataset, shuffle_memory_mb=shuffle_memory_mb, input_shard=input_shard)
+      ds = self._create_dtitle_dataset(records, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, self.EOS_id)
     elif data_file.endswith('.tfrecord') or data_file.endswith('.tfrecord.gz'):
       logging.info(f'open one tfrecord dataset from "{data_file}".')
-      ds = self._create_tfrecord_dataset(data_file, batch_size, max_input_length, max_target_length)
+      records = self._create_record_dataset(data_file, tf.data.TFRecordDataset, shard_by_hint=data_service is not None, shuffle_memory_mb=shuffle_memory_mb, input_shard=input_shard)
+      ds = self._create_tfrecord_dataset(records, batch_size, max_input_length, max_target_length)
     elif data_file.endswith('.tokenized-tfrecord') or data_file.endswith('.tokenized-tfrecord.gz'):
       logging.info(f'open one tokenized-tfrecord dataset from "{data_file}".')
-      ds = self._create_tokenized_tfrecord_dataset(data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, self.EOS_id)
+      records = self._create_record_dataset(data_file, tf.data.TFRecordDataset, shard_by_hint=data_service is not None, shuffle_memory_mb=shuffle_memory_mb, input_shard=input_shard)
+      ds = self._create_tokenized_tfrecord_dataset(records, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, self.EOS_id)
     elif data_file.endswith('.dtitle.tokenized') or data_file.endswith('.dtitle.tokenized.gz'):
       logging.info(f'open one dtitle-tokenized dataset from "{data_file}".')
-      ds = self._create_dtitle_tokenized_dataset(data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, self.EOS_id)
+      records = self._create_record_dataset(data_file, tf.data.TFRecordDataset, shard_by_hint=data_service is not None, shuffle_memory_mb=shuffle_memory_mb, input_shard=input_shard)
+      ds = self._create_dtitle_tokenized_dataset(records, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, self.EOS_id)
+    elif data_file.endswith('.dtitle.mmap'):
+      logging.info(f'open one dtitle-mmap dataset from "{data_file}".')
+      if data_service:
+        raise ValueError(f'dtitle mmap dataset uses tf.numpy_function and can\'t be served by tf.data service: {data_file}')
+      ds = self._create_dtitle_mmap_dataset(data_file, batch_size, max_input_length, max_target_length, self.EOS_id,
+                                            shuffle=bool(shuffle_memory_mb), input_shard=input_shard)
     else:
       raise ValueError(f'invalid input file format: {data_file}')
 
     cache_desc = f'{data_file}.{batch_size}_{max_input_length}_{max_target_length}_{url_segment_limit}_{hostname_segment_limit}.cache'
-    if create_cache or os.path.isfile(f'{cache_desc}.index'):
+    if not shuffle_memory_mb and (create_cache or os.path.isfile(f'{cache_desc}.index')):
       ds = ds.cache(cache_desc)
     if repeat != 1:
       ds = ds.repeat(repeat)
-    if shuffle_size:
-      ds = ds.shuffle(shuffle_size // batch_size)
+    if self.flags_obj.length_buckets and trim:
+      # a few distinct input lengths, so the model function is traced a bounded number of times
+      length_buckets = self._get_length_buckets()
+      ds = ds.map(lambda x, y: (self._trim_batch(x, length_buckets), y))
     ds = ds.map(lambda x, y: ((x, y), y))
+    if data_service:
+      ds = data_service.distribute(ds)
+    if input_shard is not None:
+      options = tf.data.Options()
+      options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+      ds = ds.with_options(options)
     ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
 
     return ds
@@ -693,27 +1382,140 @@ def test_read_and_dump_datasets(task):
 
 
 def count_token_id_freq(task):
-  from collections import Counter
+  # per-column histograms of a whole training set: process_dtitle_data.py --cmd=count-token-freq
+  vocab_size = task.params['vocab_size']
   ds = task._create_dataset(task.params['data_dir'], repeat=1)
-  freq = Counter()
-  for batch, ((inp, tar), _) in enumerate(ds):
-    if batch % (1024) == 0:
-      print(f'batch = {batch//1024}K')
-    for inp1, tar1 in zip(inp, tar):
-      #freq.update(inp1.numpy())
-      freq.update(tar1.numpy())
-  print(f'batch = {batch}')
+  def _bincount(freq, batch):
+    (inp, tar), _ = batch
+    return freq + tf.math.bincount(tar, minlength=vocab_size, maxlength=vocab_size, dtype=tf.int64)
+  freq = ds.reduce(tf.zeros([vocab_size], tf.int64), _bincount).numpy()
+  print(f'count {freq.sum()} target tokens')
   with open('token_id_freq.txt', 'w') as ow:
-    for key, value in freq.items():
-      ow.write(f'{key}\t{value}\n')
+    for key in np.flatnonzero(freq):
+      ow.write(f'{key}\t{freq[key]}\n')
 
 
 def test(task):
   #test_read_and_dump_datasets(task)
   count_token_id_freq(task)
 
+
+def bench_input(task):
+  """Benchmarks the input pipeline alone (no model) for every data file and input schema.
+
+  The batches are consumed by Dataset.reduce, so no per-batch python code is
+  measured. Stages are timed separately: raw record reading (decompression) and
+  the whole _create_dataset pipeline (parse, truncate, filter, pad and batch).
+  """
+  flags_obj, params = task.flags_obj, task.params
+  batch_count = flags_obj.bench_input_batches
+  batch_size = params['batch_size']
+  data_files = (flags_obj.bench_input_files or params['data_dir']).split(',')
+
+  def _count_records(ds):
+    start_time = time.time()
+    count = ds.take(batch_count * batch_size).reduce(tf.constant(0, tf.int64), lambda n, _: n + 1).numpy()
+    return count, time.time() - start_time
+
+  def _count_tokens(ds):
+    def _accumulate(state, batch):
+      (inp, tar), _ = batch
+      return (state[0] + tf.cast(tf.shape(inp)[0], tf.int64),
+              state[1] + tf.math.count_nonzero(inp, dtype=tf.int64) + tf.math.count_nonzero(tar, dtype=tf.int64),
+              state[2] + tf.cast(tf.size(inp) + tf.size(tar), tf.int64))
+    start_time = time.time()
+    zero = tf.constant(0, tf.int64)
+    examples, tokens, slots = ds.take(batch_count).reduce((zero, zero, zero), _accumulate)
+    return examples.numpy(), tokens.numpy(), slots.numpy(), time.time() - start_time
+
+  rows = []
+  default_schema = flags_obj.input_concat_schema
+  for data_file in data_files:
+    is_text = data_file.endswith('.dtitle') or data_file.endswith('.dtitle.gz')
+    if data_file == '__random_input__' or data_file.endswith('.dtitle.mmap'):
+      read_us = 0.0  # no separate record reading stage
+    else:
+      records = task._create_record_dataset(data_file, tf.data.TextLineDataset if is_text else tf.data.TFRecordDataset)
+      record_count, seconds = _count_records(records)
+      read_us = seconds / max(record_count, 1) * 1e6
+    schemas = ['v0', 'v1', 'v2', 'v3', 'v4'] if is_text else [flags_obj.training_schema]
+    for schema in schemas:
+      if is_text:
+        flags_obj.input_concat_schema = schema
+      start_time = time.time()
+      next(iter(task._create_dataset(data_file, repeat=None)))
+      first_batch_seconds = time.time() - start_time
+      examples, tokens, slots, seconds = _count_tokens(task._create_dataset(data_file, repeat=None))
+      rows.append([os.path.basename(data_file), schema, f'{first_batch_seconds:.2f}', f'{read_us:.1f}',
+                   f'{seconds / batch_count * 1000:.2f}', f'{examples / seconds:.1f}', f'{tokens / seconds:.0f}',
+                   f'{tokens / max(slots, 1):.3f}'])
+      logging.info(f'bench-input: {rows[-1]}')
+  flags_obj.input_concat_schema = default_schema
+
+  if flags_obj.shuffle_memory_mb:
+    for data_file in data_files:
+      if data_file != '__random_input__' and not data_file.endswith('.dtitle.mmap'):
+        is_text = data_file.endswith('.dtitle') or data_file.endswith('.dtitle.gz')
+        task._report_shuffle_mixing(data_file, tf.data.TextLineDataset if is_text else tf.data.TFRecordDataset, flags_obj.shuffle_memory_mb)
+
+  header = ['data_file', 'schema', 'first_batch(s)', 'read(us/record)', 'pipeline(ms/batch)', 'examples/s', 'real_tokens/s', 'real_token_ratio']
+  table = '\n'.join('\t'.join(row) for row in [header] + rows)
+  logging.info(f'input pipeline benchmark, batch_size = {batch_size}, batches = {batch_count}:\n{table}')
+
+def bench_train(task):
+  """Benchmarks training steps of the model alone, e.g. to compare --dtype=fp32 and --dtype=bf16.
+
+  Use --data_dir=__random_input__ to exclude the input pipeline. The first fit
+  call traces the model and warms up, only the second one is timed.
+  """
+  flags_obj, params = task.flags_obj, task.params
+  steps = flags_obj.bench_train_steps
+  ds = task._create_dataset(params['data_dir'], repeat=None)
+  if flags_obj.grad_accum_steps > 1:
+    ds = task._group_micro_batches(ds, flags_obj.grad_accum_steps)
+  with distribution_utils.get_strategy_scope(task.distribution_strategy):
+    model = task.create_model(mode='train')
+    model.compile(optimizer=task._create_optimizer(params), loss=task._create_loss_fn(params), **task._jit_compile_args())
+
+  model.fit(ds, epochs=1, steps_per_epoch=max(steps // 10, 2), verbose=0)
+  start_time = time.time()
+  history = model.fit(ds, epochs=1, steps_per_epoch=steps, verbose=0)
+  seconds = time.time() - start_time
+
+  result = {
+      'dtype': flags_obj.dtype,
+      'use_reformer': flags_obj.use_reformer,
+      'batch_size': params['batch_size'] * flags_obj.grad_accum_steps,
+      'max_input_length': params['max_input_length'],
+      'recompute_encoder_layers': flags_obj.recompute_encoder_layers,
+      'reversible_encoder': flags_obj.reversible_encoder,
+      'ffn_chunk_size': flags_obj.ffn_chunk_size,
+      'logits_chunk_size': flags_obj.logits_chunk_size,
+      'intra_op_parallelism_threads': flags_obj.intra_op_parallelism_threads,
+      'inter_op_parallelism_threads': flags_obj.inter_op_parallelism_threads,
+      'num_parallel_calls': flags_obj.num_parallel_calls or 0,
+      'steps': steps,
+      'steps_per_sec': steps / seconds,
+      'examples_per_sec': steps * params['batch_size'] / seconds,
+      'loss': float(history.history['loss'][-1]),
+      'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # ru_maxrss is in KB on linux
+  }
+  logging.info(f'bench-train result: {json.dumps(result)}')
+  return result
+
 def main(_):
   flags_obj = flags.FLAGS
+  if flags_obj.mode == 'autotune':
+    # trials run in their own processes, this one doesn't start TF
+    autotune.autotune(flags_obj)
+    return
+  if flags_obj.tuned_config_file and flags_obj.mode in ('train', 'predict'):
+    autotune.load_tuned_config(flags_obj, flags_obj.mode)
+  # thread pools must be sized before the TF runtime starts, i.e. before Seq2SeqTask
+  if flags_obj.intra_op_parallelism_threads:
+    tf.config.threading.set_intra_op_parallelism_threads(flags_obj.intra_op_parallelism_threads)
+  if flags_obj.inter_op_parallelism_threads:
+    tf.config.threading.set_inter_op_parallelism_threads(flags_obj.inter_op_parallelism_threads)
   task = Seq2SeqTask(flags_obj)
   if flags_obj.mode == "train":
     task.train()
@@ -730,8 +1532,16 @@ def main(_):
     task.predict()
   elif flags_obj.mode == "eval":
     task.eval()
+  elif flags_obj.mode == "eval-watch":
+    task.eval_watch()
+  elif flags_obj.mode == "eval-sweep":
+    task.eval_sweep()
   elif flags_obj.mode == 'test':
     test(task)
+  elif flags_obj.mode == 'bench-input':
+    bench_input(task)
+  elif flags_obj.mode == 'bench-train':
+    bench_train(task)
   else:
     raise ValueError(f'invalid mode : {flags_obj.mode}')
 
@@ -22,6 +22,8 @@ Metrics:
 """
 import tensorflow as tf
 
+import utils as model_utils
+
 
 def _pad_tensors_to_same_length(x, y):
   """Pad x and y so that the results have the same length (second dimension)."""
@@ -50,19 +52,26 @@ def padded_cross_entropy_loss(logits, labels, smoothing, vocab_size):
       shape [batch_size, max(length_logits, length_labels)]
   """
   with tf.name_scope("loss"):
-    logits, labels = _pad_tensors_to_same_length(logits, labels)
+    logits_length = tf.shape(logits)[1]
+    labels_length = tf.shape(labels)[1]
+    max_length = tf.maximum(logits_length, labels_length)
+    labels = tf.pad(labels, [[0, 0], [0, max_length - labels_length]])
 
     # Calculate smoothing cross entropy
     with tf.name_scope("smoothing_cross_entropy"):
       confidence = 1.0 - smoothing
       low_confidence = (1.0 - confidence) / tf.cast(vocab_size - 1, tf.float32)
-      soft_targets = tf.one_hot(
-          tf.cast(labels, tf.int32),
-          depth=vocab_size,
-          on_value=confidence,
-          off_value=low_confidence)
-      xentropy = tf.nn.softmax_cross_entropy_with_logits(
-          logits=logits, labels=soft_targets)
+      # Same as softmax_cross_entropy_with_logits on the one-hot soft targets
+      # (confidence on the label, low_confidence elsewhere), without allocating
+      # them: -sum(soft_targets * log_softmax(logits)) = logsumexp(logits) -
+      # (confidence - low_confidence) * label_logit - low_confidence * sum(logits)
+      label_logits = tf.gather(logits, tf.cast(labels[:, :logits_length], tf.int32), batch_dims=2)
+      xentropy = (tf.reduce_logsumexp(logits, axis=-1)
+                  - (confidence - low_confidence) * label_logits
+                  - low_confidence * tf.reduce_sum(logits, axis=-1))
+      # positions beyond the logits have all-zero logits in the one-hot version
+      xentropy = tf.pad(xentropy, [[0, 0], [0, max_length - logits_length]],
+                        constant_values=tf.math.log(tf.cast(vocab_size, xentropy.dtype)))
 
       # Calculate the best (lowest) possible value of cross entropy, and
       # subtract from the cross entropy loss.
@@ -76,6 +85,34 @@ def padded_cross_entropy_loss(logits, labels, smoothing, vocab_size):
     return xentropy * weights, weights
 
 
+def chunked_padded_cross_entropy_loss(logits_fn, outputs, labels, smoothing, vocab_size, chunk_size, training):
+  """padded_cross_entropy_loss of logits_fn(outputs), for chunk_size positions at a time.
+
+  The [batch_size, length, vocab_size] logits (and the softmax of the backward
+  pass) exist for one slice of positions at a time: in training, every slice is
+  recomputed in the backward pass instead of kept.
+
+  Args:
+    logits_fn: maps [batch_size, n, hidden_size] outputs to [batch_size, n, vocab_size] float32 logits
+    outputs: Tensor of size [batch_size, length, hidden_size]
+    labels: Tensor of size [batch_size, length]
+    smoothing: Label smoothing constant, used to determine the on and off values
+    vocab_size: int size of the vocabulary
+    chunk_size: int number of positions per slice
+    training: boolean, whether in training mode or not.
+
+  Returns:
+    The cross entropy loss multiplied by the weights of padded_cross_entropy_loss,
+      a float32 tensor with shape [batch_size, length]
+  """
+  def _chunk_loss(outputs, labels):
+    # int labels are captured, as recompute_grad differentiates w.r.t. all of its arguments
+    fn = lambda outputs: tf.multiply(*padded_cross_entropy_loss(logits_fn(outputs), labels, smoothing, vocab_size))
+    return model_utils.recompute_grad(fn)(outputs) if training else fn(outputs)
+  with tf.name_scope("chunked_loss"):
+    return model_utils.chunked_map(_chunk_loss, [outputs, labels], chunk_size, dtype=tf.float32)
+
+
 def padded_accuracy(logits, labels):
   """Percentage of times that predictions matches labels on non-0s."""
   with tf.name_scope("padded_accuracy"):
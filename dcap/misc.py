@@ -62,8 +62,8 @@ def define_transformer_flags():
   flags_core.define_base(num_gpu=True, distribution_strategy=True)
   flags_core.define_performance(
       num_parallel_calls=True,
-      inter_op=False,
-      intra_op=False,
+      inter_op=True,
+      intra_op=True,
       synthetic_data=True,
       max_train_steps=False,
       dtype=True,
@@ -115,7 +115,9 @@ def define_transformer_flags():
       'the first and last step to profile. For example, "--profile_steps=2,4" '
       'triggers the profiler to process 3 steps, starting from the 2nd step. '
       'Note that profiler has a non-trivial performance overhead, and the '
-      'output file can be gigantic if profiling many steps.')
+      'output file can be gigantic if profiling many steps. Used by train '
+      'and predict, which also write the top ops by self time to '
+      'model_dir/top-ops.{train,predict}.tsv.')
   # Set flags from the flags_core module as 'key flags' so they're listed when
   # the '-h' flag is used. Without this line, the flags defined above are
   # only shown in the full `--helpful` help text.
@@ -175,12 +177,18 @@ def define_transformer_flags():
           'the vocab file.'))
   flags.DEFINE_string(
       name='mode', default='train',
-      help=flags_core.help_wrap('mode: train, eval, or predict'))
+      help=flags_core.help_wrap('mode: train, eval, eval-watch, eval-sweep, predict, test, bench-input, bench-train or autotune'))
   flags.DEFINE_bool(
       name='use_ctl',
       default=False,
       help=flags_core.help_wrap(
           'Whether the model runs with custom training loop.'))
+  flags.DEFINE_integer(
+      name='steps_per_loop',
+      default=100,
+      help=flags_core.help_wrap(
+          'The number of training steps run by one call of the compiled '
+          'training function in the custom training loop (--use_ctl).'))
   flags.DEFINE_bool(
       name='use_tpu_2vm_config',
       default=False,
@@ -212,16 +220,19 @@ def define_transformer_flags():
           'the max sequence length.'))
 
   flags.DEFINE_string(
-      name='loss_fn', default='smoothed_corss_entropy',
-      help=flags_core.help_wrap('loss_fn: corss_entropy, smoothed_corss_entropy'))
+      name='loss_fn', default='smoothed_cross_entropy',
+      help=flags_core.help_wrap('loss_fn: smoothed_cross_entropy (label_smoothing of the param set), '
+                                'or cross_entropy'))
 
   flags.DEFINE_string(
       name='input_concat_schema', default='v2',
       help=flags_core.help_wrap(
-          'input_concat_schema: [v0, v1, v2, v3]. v0: html only; '
+          'input_concat_schema: [v0, v1, v2, v3, v4]. v0: html only; '
           'v1: concatenated (url, hostname, html); '
           'v2: concatenated and padded (url, hostname, html); '
-          'v3: padded (url, hostname, html)'))
+          'v3: padded (url, hostname, html); '
+          'v4: packed without padding, segments are ended by <EOS#i> and '
+          'marked by segment embeddings (also for dtitle-tokenized data)'))
 
   flags.DEFINE_bool(
       name='compact_predict_result', default=False,
@@ -315,6 +326,190 @@ def define_transformer_flags():
       name='dedup_predict_input', default=False,
       help=flags_core.help_wrap('remove duplicated inputs in predict'))
 
+  flags.DEFINE_integer(
+      name='bench_input_batches', default=1000,
+      help=flags_core.help_wrap('The number of batches to read in bench-input mode.'))
+
+  flags.DEFINE_integer(
+      name='bench_train_steps', default=50,
+      help=flags_core.help_wrap('The number of timed training steps in bench-train mode.'))
+
+  flags.DEFINE_string(
+      name='bench_input_files', default=None,
+      help=flags_core.help_wrap(
+          'Comma separated data files to compare in bench-input mode, e.g. the '
+          'same data in different file formats. If None, use data_dir.'))
+
+  flags.DEFINE_integer(
+      name='data_service_workers', default=0,
+      help=flags_core.help_wrap(
+          'Number of local tf.data service worker processes to build the training '
+          'input pipeline in, 0 means building it in the trainer process. Start '
+          'with 1 and add workers while the training throughput still grows, see '
+          'data_service.py for details. Requires TF 2.7+.'))
+
+  flags.DEFINE_integer(
+      name='data_service_port', default=5050,
+      help=flags_core.help_wrap(
+          'Port of the local tf.data service dispatcher, workers use the '
+          'following data_service_workers ports.'))
+
+  flags.DEFINE_integer(
+      name='grad_accum_steps', default=1,
+      help=flags_core.help_wrap(
+          'Sum the gradients of this many batches (of batch_size) before every '
+          'optimizer step, for an effective batch size of batch_size * '
+          'grad_accum_steps. train_steps, steps_between_evals and the learning '
+          'rate schedule count optimizer steps.'))
+
+  flags.DEFINE_string(
+      name='length_buckets', default=None,
+      help=flags_core.help_wrap(
+          'Comma separated input lengths, e.g. 64,128,256. If set, every input '
+          'batch is trimmed to the smallest length (or max_input_length) that '
+          'holds its longest non-padding input, in train, eval and predict. '
+          'With use_reformer, lengths are rounded up to multiples of '
+          '2*bucket_size.'))
+
+  flags.DEFINE_integer(
+      name='shuffle_memory_mb', default=0,
+      help=flags_core.help_wrap(
+          'Memory budget (MB) of the training data shuffle buffers, 0 means '
+          'reading the training data in file order. Files, blocks of '
+          'shuffle_block_records records and single records are shuffled in '
+          'turn; bench-input mode reports how well the output is mixed.'))
+
+  flags.DEFINE_integer(
+      name='shuffle_block_records', default=1024,
+      help=flags_core.help_wrap('The number of contiguous records in a block of the block-level shuffle.'))
+
+  flags.DEFINE_bool(
+      name='async_checkpoint', default=False,
+      help=flags_core.help_wrap(
+          'Write checkpoints in a background thread, so training only pauses '
+          'to snapshot the variables. Needs TF 2.11+, it has no effect on '
+          'older TF, where checkpoints are written synchronously.'))
+
+  flags.DEFINE_integer(
+      name='eval_watch_interval_secs', default=60,
+      help=flags_core.help_wrap(
+          'With --mode=eval-watch, the minimal number of seconds between two '
+          'checks of model_dir for a new checkpoint.'))
+
+  flags.DEFINE_integer(
+      name='eval_watch_timeout_secs', default=0,
+      help=flags_core.help_wrap(
+          'With --mode=eval-watch, stop when there is no new checkpoint for '
+          'this number of seconds. 0 to wait forever.'))
+
+  flags.DEFINE_list(
+      name='eval_sweep_settings', default=['full', '1', '2', '4', '8', '16', '32', '64'],
+      help=flags_core.help_wrap(
+          'Settings compared by --mode=eval-sweep on the same cached batches: '
+          'test_num_hashes values of the LSH attention, or full for '
+          'use_full_attention_in_reformer.'))
+
+  flags.DEFINE_bool(
+      name='recompute_encoder_layers', default=False,
+      help=flags_core.help_wrap(
+          'Keep only the input of every encoder layer for the backward pass '
+          'and recompute its activations there (tf.recompute_grad), which '
+          'trades ~1/3 more compute for less peak memory with long inputs. '
+          'Compare peak_rss_mb with make bench-recompute.'))
+
+  flags.DEFINE_string(
+      name='tuned_config_file', default=None,
+      help=flags_core.help_wrap(
+          'JSON file of the tuned batch_size, intra/inter-op threads and '
+          'num_parallel_calls. --mode=autotune writes it; train loads all of '
+          'them from it and predict all but batch_size, overriding the '
+          'command line.'))
+
+  flags.DEFINE_list(
+      name='autotune_batch_sizes', default=['16', '32', '64', '128'],
+      help=flags_core.help_wrap(
+          'Batch sizes tried by --mode=autotune, in increasing order until a '
+          'trial fails or exceeds autotune_max_rss_mb.'))
+
+  flags.DEFINE_list(
+      name='autotune_num_parallel_calls', default=['0', '2', '4', '8'],
+      help=flags_core.help_wrap(
+          'num_parallel_calls of the input pipeline tried by --mode=autotune, '
+          '0 means tf.data AUTOTUNE.'))
+
+  flags.DEFINE_integer(
+      name='autotune_max_rss_mb', default=0,
+      help=flags_core.help_wrap(
+          'Memory ceiling of --mode=autotune: trials whose peak RSS exceeds '
+          'this number of MB are rejected. 0 for no ceiling.'))
+
+  flags.DEFINE_integer(
+      name='ffn_chunk_size', default=0,
+      help=flags_core.help_wrap(
+          'If positive, the feedforward networks of encoder and decoder run '
+          'on slices of this many positions in turn, so their '
+          '[batch_size, length, filter_size] intermediate exists for one '
+          'slice at a time; in training a slice is recomputed in the '
+          'backward pass. Results are unchanged, 0 disables it.'))
+
+  flags.DEFINE_integer(
+      name='logits_chunk_size', default=0,
+      help=flags_core.help_wrap(
+          'If positive, the output logits and the loss of training and eval '
+          'are computed together for slices of this many target positions in '
+          'turn, and in training every slice is recomputed in the backward '
+          'pass, so the [batch_size, length, vocab_size] logits never exist '
+          'in full. The loss is unchanged; the token/sequence accuracy '
+          'metrics, which need the full logits, are disabled. 0 disables it.'))
+
+  flags.DEFINE_bool(
+      name='reversible_encoder', default=False,
+      help=flags_core.help_wrap(
+          'With use_reformer, use reversible residual encoder layers: the '
+          'backward pass reconstructs the input of every encoder layer from '
+          'its output, so the encoder memory stays flat in num_hidden_layers. '
+          'Compare peak_rss_mb over input lengths with make bench-reversible.'))
+
+  flags.DEFINE_bool(
+      name='enable_step_stats', default=False,
+      help=flags_core.help_wrap(
+          'Record the input wait, compute time, examples/s, real tokens/s, '
+          'padding fraction and RSS of every training step, and log their '
+          'percentiles to the log, model_dir/step-stats.*.csv, the CSV history '
+          'and TensorBoard, to tell if training is input-bound or compute-bound.'))
+
+  flags.DEFINE_integer(
+      name='step_stats_window', default=100,
+      help=flags_core.help_wrap(
+          'Number of steps of every window that step stats percentiles are '
+          'computed from.'))
+
+  flags.DEFINE_integer(
+      name='checkpoint_interval_steps', default=0,
+      help=flags_core.help_wrap(
+          'Besides the checkpoint at the end of each epoch, save an interim '
+          'checkpoint (in model_dir/interim, only the latest is kept) every N '
+          'training steps. 0 to disable. An interim checkpoint is also saved '
+          'when the training process receives SIGTERM.'))
+
+  flags.DEFINE_integer(
+      name='checkpoint_interval_secs', default=0,
+      help=flags_core.help_wrap(
+          'Save an interim checkpoint every N seconds of training, e.g. 1800 '
+          'on preemptible machines. 0 to disable.'))
+
+  flags.DEFINE_bool(
+      name='checkpoint_input_iterator', default=False,
+      help=flags_core.help_wrap(
+          'Save the position of the training input iterator together with the '
+          'model, so that a resumed training continues from the next unread '
+          'example instead of the beginning of data_dir. Training runs with '
+          'the custom training loop (as --use_ctl), whose train function reads '
+          'the iterator. Not supported by the .dtitle text format and tf.data '
+          'service.'))
+
   flags_core.set_defaults(data_dir='/tmp/translate_ende',
                           model_dir='/tmp/transformer_model',
-                          batch_size=16)
+                          batch_size=16,
+                          # 0 is tf.data AUTOTUNE for the input pipeline map stages
+                          num_parallel_calls=0)
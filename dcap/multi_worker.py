@@ -0,0 +1,97 @@
+"""Multi-process CPU data-parallel training with MultiWorkerMirroredStrategy.
+
+Each worker is one dtitle.py process with one replica; gradients are
+all-reduced over grpc. TF_CONFIG tells a worker the addresses of all workers
+and its own index; worker 0 is the chief.
+
+Launch N workers on this host, each pinned to 1/N of the cores:
+  python3 multi_worker.py --workers_per_host=4 -- python3 dtitle.py \\
+      --distribution_strategy=multi_worker_mirrored ...
+
+Launch on several hosts, by running the same command on every host with
+its own --host_index:
+  python3 multi_worker.py --hosts=node0,node1 --host_index=0 --workers_per_host=4 -- ...
+
+Notes:
+  * --batch_size is per worker, the global batch is batch_size * #workers.
+  * every worker reads a disjoint shard of the training data.
+  * only the chief writes checkpoints and logs to --model_dir, which must be a
+    shared directory when workers run on several hosts.
+  * a worker process uses as many intra-op threads as cores it's pinned to.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+from absl import app
+from absl import flags
+from absl import logging
+
+
+def make_tf_config(worker_addresses, task_index):
+  """Returns the TF_CONFIG (json string) of worker task_index in a cluster of worker_addresses."""
+  return json.dumps({
+      'cluster': {'worker': list(worker_addresses)},
+      'task': {'type': 'worker', 'index': task_index},
+  })
+
+
+def get_worker_info():
+  """Returns (num_workers, task_index) of this process from TF_CONFIG, (1, 0) if it's unset."""
+  tf_config = json.loads(os.environ.get('TF_CONFIG') or '{}')
+  num_workers = len(tf_config.get('cluster', {}).get('worker', [])) or 1
+  return num_workers, tf_config.get('task', {}).get('index', 0)
+
+
+def is_chief():
+  return get_worker_info()[1] == 0
+
+
+def split_cores(num_workers):
+  """Splits the cores this process can run on into num_workers contiguous sets."""
+  cores = sorted(os.sched_getaffinity(0))
+  per_worker = max(len(cores) // num_workers, 1)
+  return [set(cores[i * per_worker:(i + 1) * per_worker] or cores) for i in range(num_workers)]
+
+
+def launch(cmd, hosts, host_index, workers_per_host, port):
+  """Runs workers_per_host copies of cmd on this host, returns the max exit code of them.
+
+  Worker j of host h listens at hosts[h]:(port + j), and has task index
+  h * workers_per_host + j.
+  """
+  worker_addresses = [f'{host}:{port + j}' for host in hosts for j in range(workers_per_host)]
+  processes = []
+  for j, cores in enumerate(split_cores(workers_per_host)):
+    task_index = host_index * workers_per_host + j
+    env = dict(os.environ, TF_CONFIG=make_tf_config(worker_addresses, task_index))
+    logging.info(f'start worker {task_index} at {worker_addresses[task_index]} on cores {sorted(cores)}')
+    processes.append(subprocess.Popen(cmd, env=env, preexec_fn=lambda cores=cores: os.sched_setaffinity(0, cores)))
+  try:
+    return max(proc.wait() for proc in processes)
+  except KeyboardInterrupt:
+    for proc in processes:
+      proc.terminate()  # workers save an interim checkpoint on SIGTERM
+    return max(proc.wait() for proc in processes)
+
+
+def define_flags():
+  flags.DEFINE_list('hosts', ['localhost'], 'Hosts of the cluster, every one runs workers_per_host workers.')
+  flags.DEFINE_integer('host_index', 0, 'Index of this host in --hosts.')
+  flags.DEFINE_integer('workers_per_host', 2, 'Number of worker processes on each host.')
+  flags.DEFINE_integer('port', 23456, 'Worker j listens at port + j of its host.')
+
+
+def main(argv):
+  cmd = argv[1:]
+  if not cmd:
+    raise app.UsageError('missing the command of workers, e.g. -- python3 dtitle.py ...')
+  FLAGS = flags.FLAGS
+  sys.exit(launch(cmd, FLAGS.hosts, FLAGS.host_index, FLAGS.workers_per_host, FLAGS.port))
+
+
+if __name__ == '__main__':
+  define_flags()
+  app.run(main)
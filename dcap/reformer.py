@@ -11,7 +11,6 @@ import utils as model_utils
 import attention_layer
 from official.transformer.v2 import beam_search
 from official.transformer.v2 import embedding_layer
-from official.transformer.v2 import ffn_layer
 import metrics
 
 
@@ -25,23 +24,32 @@ def create_model(params, mode):
   """Creates model."""
   with tf.name_scope("model"):
     input_len, output_len = params['max_input_length'], params['max_target_length']
+    if params.get('trim_input_length'):
+      input_len = None  # batches are trimmed to one of the length buckets
     batch_size = params['batch_size']
     if mode == 'train' or mode == 'eval':
       inputs = tf.keras.layers.Input((input_len,), batch_size, dtype="int32", name="inputs")
       targets = tf.keras.layers.Input((output_len,), batch_size, dtype="int32", name="targets")
-      internal_model = Reformer(params, name="reformer")
+      # with logits_chunk_size, the model outputs the loss of every position instead of the logits
+      chunked_loss = bool(params.get("logits_chunk_size"))
+      internal_model = Reformer(params, name="reformer", output_xentropy=chunked_loss)
       logits = internal_model([inputs, targets], training=mode == 'train')
-      if params["enable_metrics_in_training"]:
+      if params["enable_metrics_in_training"] and not chunked_loss:
         vocab_size = params["vocab_size"]
         label_smoothing = params["label_smoothing"]
         logits = metrics.MetricLayer(vocab_size, label_smoothing)([logits, targets])
       logits = tf.keras.layers.Lambda(lambda x: x, name="logits",
                                       dtype=tf.float32)(logits)
-      model = tf.keras.Model([inputs, targets], logits)
+      if params.get("grad_accum_steps", 1) > 1:
+        model = model_utils.GradientAccumulationModel([inputs, targets], logits, params["grad_accum_steps"])
+      else:
+        model = tf.keras.Model([inputs, targets], logits)
       return model
     else:
-      inputs = tf.keras.layers.Input((input_len,), dtype="int32", name="inputs")
-      targets = tf.keras.layers.Input((None,), dtype="int32", name="targets")
+      # padded decoding needs a static batch size
+      batch_size = batch_size if params["padded_decode"] else None
+      inputs = tf.keras.layers.Input((input_len,), batch_size, dtype="int32", name="inputs")
+      targets = tf.keras.layers.Input((None,), batch_size, dtype="int32", name="targets")
       internal_model = Reformer(params, name="reformer")
       ret = internal_model([inputs], training=False)
       logits = internal_model([inputs, targets], training=False)
@@ -59,21 +67,28 @@ class Reformer(tf.keras.Model):
   probabilities for the output sequence.
   """
 
-  def __init__(self, params, name=None):
+  def __init__(self, params, name=None, output_xentropy=False):
     """Initialize layers to build model.
 
     Args:
       params: hyperparameter object defining layer sizes, dropout values, etc.
       name: name of the model.
+      output_xentropy: whether call with targets returns the (weighted) cross
+        entropy loss of every target position instead of the logits, computed
+        by metrics.chunked_padded_cross_entropy_loss.
     """
     super(Reformer, self).__init__(name=name)
     self.params = params
+    self.output_xentropy = output_xentropy
     self.positional_encoding_strategy = pes = FLAGS.positional_encoding_strategy
     self.positional_encoding_concat_dimension = int(pes[7:]) if pes.startswith('concat-') else 0
     self.embedding_softmax_layer = embedding_layer.EmbeddingSharedWeights(
         params["vocab_size"], params["hidden_size"] - self.positional_encoding_concat_dimension)
+    if params.get("num_segment_types"):
+      self.segment_embedding = tf.keras.layers.Embedding(
+          params["num_segment_types"], params["hidden_size"] - self.positional_encoding_concat_dimension, name="segment_embedding")
 
-    self.encoder_stack = EncoderStack(params)
+    self.encoder_stack = RevEncoderStack(params) if params.get("reversible_encoder") else EncoderStack(params)
     self.decoder_stack = DecoderStack(params)
 
   def get_config(self):
@@ -107,8 +122,8 @@ class Reformer(tf.keras.Model):
       inputs, targets = inputs[0], inputs[1]
     else:
       inputs, targets = inputs[0], None
-      if self.params["padded_decode"]:
-        raise NotImplementedError("Padded decoding is not supported.")
+      if self.params["padded_decode"] and not self.params.get("static_shapes"):
+        raise NotImplementedError("Padded decoding is only supported with XLA.")
 
     # Variance scaling is used here because it seems to work in many problems.
     # Other reasonable initializers may also work just as well.
@@ -157,6 +172,9 @@ class Reformer(tf.keras.Model):
       # Prepare inputs to the layer stack by adding positional encodings and
       # applying dropout.
       embedded_inputs = self.embedding_softmax_layer(inputs)
+      if self.params.get("num_segment_types"):
+        segment_ids = model_utils.get_segment_ids(inputs, self.params["segment_end_id"], self.params["num_segment_types"])
+        embedded_inputs += tf.cast(self.segment_embedding(segment_ids), embedded_inputs.dtype)
       embedded_inputs = tf.cast(embedded_inputs, self.params["dtype"])
       padding_mask = tf.cast(tf.equal(inputs, 0), tf.bool)  # assume inputs is padded by '0'
 
@@ -212,9 +230,16 @@ class Reformer(tf.keras.Model):
           training=training)
       if self.positional_encoding_concat_dimension > 0:
         outputs = outputs[:, :, :-self.positional_encoding_concat_dimension]
-      logits = self.embedding_softmax_layer(outputs, mode="linear")
-      logits = tf.cast(logits, tf.float32)
-      return logits
+      if self.output_xentropy:
+        # targets are the labels, the logits exist for a slice of positions at a time
+        return metrics.chunked_padded_cross_entropy_loss(
+            self._float32_logits, outputs, targets, self.params["label_smoothing"], self.params["vocab_size"],
+            self.params["logits_chunk_size"], training)
+      return self._float32_logits(outputs)
+
+  def _float32_logits(self, outputs):
+    logits = self.embedding_softmax_layer(outputs, mode="linear")
+    return tf.cast(logits, tf.float32)
 
   def _get_symbols_to_logits_fn(self, max_decode_length, training):
     """Returns a decoding function that calculates logits of the next tokens."""
@@ -373,7 +398,7 @@ class LayerNormalization(tf.keras.layers.Layer):
 
   def call(self, x, epsilon=1e-6):
     input_dtype = x.dtype
-    if input_dtype == tf.float16:
+    if input_dtype == tf.float16 or input_dtype == tf.bfloat16:
       x = tf.cast(x, tf.float32)
     mean = tf.reduce_mean(x, axis=[-1], keepdims=True)
     variance = tf.reduce_mean(tf.square(x - mean), axis=[-1], keepdims=True)
@@ -384,10 +409,11 @@ class LayerNormalization(tf.keras.layers.Layer):
 class PrePostProcessingWrapper(tf.keras.layers.Layer):
   """Wrapper class that applies layer pre-processing and post-processing."""
 
-  def __init__(self, layer, params):
+  def __init__(self, layer, params, residual=True):
     super(PrePostProcessingWrapper, self).__init__()
     self.layer = layer
     self.params = params
+    self.residual = residual
     self.postprocess_dropout = params["layer_postprocess_dropout"]
 
   def build(self, input_shape):
@@ -412,10 +438,10 @@ class PrePostProcessingWrapper(tf.keras.layers.Layer):
 
     # Postprocessing: apply dropout and residual connection
     if training:
-      y = tf.nn.dropout(y, rate=self.postprocess_dropout)
+      y = model_utils.dropout(y, self.postprocess_dropout)
 
     # TODO: should the layer_norm be applied after layer according to the paper?
-    return x + y
+    return x + y if self.residual else y
 
 
 class EncoderStack(tf.keras.layers.Layer):
@@ -427,6 +453,9 @@ class EncoderStack(tf.keras.layers.Layer):
     2. Feedforward network (which is 2 fully-connected layers)
   """
 
+  # whether the sublayers add their input to their output
+  residual_sublayers = True
+
   def __init__(self, params):
     super(EncoderStack, self).__init__()
     self.params = params
@@ -440,12 +469,12 @@ class EncoderStack(tf.keras.layers.Layer):
       self_attention_layer = attention_layer.LshSelfAttention(
           params["hidden_size"], params["num_heads"],
           params["lsh_attention_dropout"], params["num_hashes"], params['test_num_hashes'], params["bucket_size"], params["use_full_attention_in_reformer"])
-      feed_forward_network = ffn_layer.FeedForwardNetwork(
-          params["hidden_size"], params["filter_size"], params["relu_dropout"])
+      feed_forward_network = model_utils.FeedForwardNetwork(
+          params["hidden_size"], params["filter_size"], params["relu_dropout"], params.get("ffn_chunk_size", 0))
 
       self.layers.append([
-          PrePostProcessingWrapper(self_attention_layer, params),
-          PrePostProcessingWrapper(feed_forward_network, params)
+          PrePostProcessingWrapper(self_attention_layer, params, residual=self.residual_sublayers),
+          PrePostProcessingWrapper(feed_forward_network, params, residual=self.residual_sublayers)
       ])
 
     # Create final layer normalization layer.
@@ -469,22 +498,134 @@ class EncoderStack(tf.keras.layers.Layer):
       Output of encoder layer stack.
       float32 tensor with shape [batch_size, input_length, hidden_size]
     """
+    recompute = training and self.params.get("recompute_encoder_layers")
     for n, layer in enumerate(self.layers):
       # Run inputs through the sublayers.
       self_attention_layer = layer[0]
       feed_forward_network = layer[1]
 
-      with tf.name_scope("layer_%d" % n):
+      def _encoder_layer(x, self_attention_layer=self_attention_layer, feed_forward_network=feed_forward_network):
         with tf.name_scope("self_attention"):
-          encoder_inputs = self_attention_layer(
-              encoder_inputs, padding_mask, training=training)
+          x = self_attention_layer(x, padding_mask, training=training)
         with tf.name_scope("ffn"):
-          encoder_inputs = feed_forward_network(
-              encoder_inputs, training=training)
+          x = feed_forward_network(x, training=training)
+        return x
+
+      with tf.name_scope("layer_%d" % n):
+        # the first call builds the sublayers, their variables can't be created inside recompute_grad
+        if recompute and self_attention_layer.built and feed_forward_network.built:
+          # only the layer input is kept, its activations are recomputed in the backward pass
+          encoder_inputs = model_utils.recompute_grad(_encoder_layer)(encoder_inputs)
+        else:
+          encoder_inputs = _encoder_layer(encoder_inputs)
 
     return self.output_normalization(encoder_inputs)
 
 
+class RevEncoderStack(EncoderStack):
+  """Reformer encoder stack of reversible residual layers.
+
+  The activations are split into two streams x1, x2 (both start as the encoder
+  inputs), and every layer computes
+    y1 = x1 + Attention(x2)
+    y2 = x2 + FeedForward(y1)
+  whose inputs can be reconstructed from its outputs
+    x2 = y2 - FeedForward(y1)
+    x1 = y1 - Attention(x2)
+  In training, the backward pass reconstructs the inputs of every layer from
+  the outputs of the stack, layer by layer in reverse, and recomputes the
+  activations of one layer at a time; so the memory kept for the backward pass
+  doesn't grow with num_hidden_layers. The random ops of dropout/LSH draw the
+  same values in the reconstruction as in the forward pass.
+  """
+
+  residual_sublayers = False
+
+  def call(self, encoder_inputs, padding_mask, training):
+    """Return the output of the encoder layer stacks.
+
+    Args:
+      encoder_inputs: tensor with shape [batch_size, input_length, hidden_size]
+      padding_mask: mask for the encoder self-attention layer, with shape [batch_size, input_length]
+      training: boolean, whether in training mode or not.
+
+    Returns:
+      Output of encoder layer stack.
+      float32 tensor with shape [batch_size, input_length, hidden_size]
+    """
+    # the first call builds the sublayers, their variables can't be created inside tf.custom_gradient
+    if training and all(sublayer.built for layer in self.layers for sublayer in layer):
+      y1, y2 = self._reversible_layers(padding_mask)(encoder_inputs, encoder_inputs)
+    else:
+      y1, y2 = encoder_inputs, encoder_inputs
+      for n, layer in enumerate(self.layers):
+        y1, y2 = self._layer_forward(n, layer, y1, y2, padding_mask, training)
+
+    return self.output_normalization((y1 + y2) / 2)
+
+  def _layer_forward(self, n, layer, x1, x2, padding_mask, training, seeds=(None, None)):
+    self_attention_layer, feed_forward_network = layer
+    with tf.name_scope("layer_%d" % n):
+      with tf.name_scope("self_attention"):
+        y1 = x1 + self._call_seeded(seeds[0], self_attention_layer, x2, padding_mask, training=training)
+      with tf.name_scope("ffn"):
+        y2 = x2 + self._call_seeded(seeds[1], feed_forward_network, y1, training=training)
+    return y1, y2
+
+  @staticmethod
+  def _call_seeded(seed, sublayer, *args, **kwargs):
+    if seed is None:
+      return sublayer(*args, **kwargs)
+    with model_utils.recompute_seed(seed):
+      return sublayer(*args, **kwargs)
+
+  def _reversible_layers(self, padding_mask):
+    """Returns fn(x1, x2) -> (y1, y2) of all layers, whose gradient reconstructs the layer inputs."""
+    # one seed per sublayer, so the reconstruction draws the same random values as the forward pass
+    seeds = [(model_utils.new_recompute_seed(), model_utils.new_recompute_seed()) for _ in self.layers]
+
+    @tf.custom_gradient
+    def _forward(x1, x2):
+      for n, layer in enumerate(self.layers):
+        x1, x2 = self._layer_forward(n, layer, x1, x2, padding_mask, True, seeds[n])
+      y1, y2 = x1, x2
+
+      def _grad(dy1, dy2, variables=None):
+        variables = list(variables or [])
+        var_grads = [None] * len(variables)
+
+        def _accumulate(grads):
+          for i, grad in enumerate(grads):
+            if grad is not None:
+              var_grads[i] = grad if var_grads[i] is None else var_grads[i] + grad
+
+        z1, z2 = y1, y2
+        for n in reversed(range(len(self.layers))):
+          self_attention_layer, feed_forward_network = self.layers[n]
+          with tf.name_scope("layer_%d_grad" % n):
+            # x2 = y2 - FeedForward(y1)
+            with tf.GradientTape() as tape:
+              tape.watch(z1)
+              g = self._call_seeded(seeds[n][1], feed_forward_network, z1, training=True)
+            grads = tape.gradient(g, [z1] + variables, output_gradients=dy2)
+            dy1 = dy1 + grads[0]
+            _accumulate(grads[1:])
+            z2 = tf.stop_gradient(z2 - g)
+            # x1 = y1 - Attention(x2)
+            with tf.GradientTape() as tape:
+              tape.watch(z2)
+              f = self._call_seeded(seeds[n][0], self_attention_layer, z2, padding_mask, training=True)
+            grads = tape.gradient(f, [z2] + variables, output_gradients=dy1)
+            dy2 = dy2 + grads[0]
+            _accumulate(grads[1:])
+            z1 = tf.stop_gradient(z1 - f)
+        return [dy1, dy2], var_grads
+
+      return (y1, y2), _grad
+
+    return _forward
+
+
 class DecoderStack(tf.keras.layers.Layer):
   """Reformer decoder stack.
 
@@ -511,8 +652,8 @@ class DecoderStack(tf.keras.layers.Layer):
       enc_dec_attention_layer = attention_layer.Attention(
           params["hidden_size"], params["num_heads"],
           params["attention_dropout"])
-      feed_forward_network = ffn_layer.FeedForwardNetwork(
-          params["hidden_size"], params["filter_size"], params["relu_dropout"])
+      feed_forward_network = model_utils.FeedForwardNetwork(
+          params["hidden_size"], params["filter_size"], params["relu_dropout"], params.get("ffn_chunk_size", 0))
 
       self.layers.append([
           PrePostProcessingWrapper(self_attention_layer, params),
@@ -28,30 +28,40 @@ from official.transformer.utils.tokenizer import EOS_ID
 import attention_layer
 from official.transformer.v2 import beam_search
 from official.transformer.v2 import embedding_layer
-from official.transformer.v2 import ffn_layer
-# TODO: ffn_layer adds another duplicated dropout layer?
 import metrics
 
 
 def create_model(params, mode):
   """Creates transformer model."""
   with tf.name_scope("model"):
+    input_len = target_len = None
+    if params.get("static_shapes"):
+      input_len, target_len = params['max_input_length'], params['max_target_length']
+      if params.get('trim_input_length'):
+        input_len = None  # batches are trimmed to one of the length buckets
     if mode == 'train' or mode == 'eval':
-      inputs = tf.keras.layers.Input((None,), dtype="int32", name="inputs")
-      targets = tf.keras.layers.Input((None,), dtype="int32", name="targets")
-      internal_model = Transformer(params, name="transformer_v2")
+      inputs = tf.keras.layers.Input((input_len,), dtype="int32", name="inputs")
+      targets = tf.keras.layers.Input((target_len,), dtype="int32", name="targets")
+      # with logits_chunk_size, the model outputs the loss of every position instead of the logits
+      chunked_loss = bool(params.get("logits_chunk_size"))
+      internal_model = Transformer(params, name="transformer_v2", output_xentropy=chunked_loss)
       logits = internal_model([inputs, targets], training=mode == 'train')
-      if params["enable_metrics_in_training"]:
+      if params["enable_metrics_in_training"] and not chunked_loss:
         vocab_size = params["vocab_size"]
         label_smoothing = params["label_smoothing"]
         logits = metrics.MetricLayer(vocab_size, label_smoothing)([logits, targets])
       logits = tf.keras.layers.Lambda(lambda x: x, name="logits",
                                       dtype=tf.float32)(logits)
-      model = tf.keras.Model([inputs, targets], logits)
+      if params.get("grad_accum_steps", 1) > 1:
+        model = model_utils.GradientAccumulationModel([inputs, targets], logits, params["grad_accum_steps"])
+      else:
+        model = tf.keras.Model([inputs, targets], logits)
       return model
     else:
-      inputs = tf.keras.layers.Input((None,), dtype="int32", name="inputs")
-      targets = tf.keras.layers.Input((None,), dtype="int32", name="targets")
+      # padded decoding needs a static batch size
+      batch_size = params['batch_size'] if params["padded_decode"] else None
+      inputs = tf.keras.layers.Input((input_len,), batch_size, dtype="int32", name="inputs")
+      targets = tf.keras.layers.Input((None,), batch_size, dtype="int32", name="targets")
       internal_model = Transformer(params, name="transformer_v2")
       ret = internal_model([inputs], training=False)
       logits = internal_model([inputs, targets], training=False)
@@ -70,17 +80,24 @@ class Transformer(tf.keras.Model):
   probabilities for the output sequence.
   """
 
-  def __init__(self, params, name=None):
+  def __init__(self, params, name=None, output_xentropy=False):
     """Initialize layers to build Transformer model.
 
     Args:
       params: hyperparameter object defining layer sizes, dropout values, etc.
       name: name of the model.
+      output_xentropy: whether call with targets returns the (weighted) cross
+        entropy loss of every target position instead of the logits, computed
+        by metrics.chunked_padded_cross_entropy_loss.
     """
     super(Transformer, self).__init__(name=name)
     self.params = params
+    self.output_xentropy = output_xentropy
     self.embedding_softmax_layer = embedding_layer.EmbeddingSharedWeights(
         params["vocab_size"], params["hidden_size"])
+    if params.get("num_segment_types"):
+      self.segment_embedding = tf.keras.layers.Embedding(
+          params["num_segment_types"], params["hidden_size"], name="segment_embedding")
     self.encoder_stack = EncoderStack(params)
     self.decoder_stack = DecoderStack(params)
 
@@ -115,8 +132,8 @@ class Transformer(tf.keras.Model):
       inputs, targets = inputs[0], inputs[1]
     else:
       inputs, targets = inputs[0], None
-      if self.params["padded_decode"]:
-        raise NotImplementedError("Padded decoding is not supported.")
+      if self.params["padded_decode"] and not self.params.get("static_shapes"):
+        raise NotImplementedError("Padded decoding is only supported with XLA.")
 
     # Variance scaling is used here because it seems to work in many problems.
     # Other reasonable initializers may also work just as well.
@@ -151,6 +168,9 @@ class Transformer(tf.keras.Model):
       # Prepare inputs to the layer stack by adding positional encodings and
       # applying dropout.
       embedded_inputs = self.embedding_softmax_layer(inputs)
+      if self.params.get("num_segment_types"):
+        segment_ids = model_utils.get_segment_ids(inputs, self.params["segment_end_id"], self.params["num_segment_types"])
+        embedded_inputs += tf.cast(self.segment_embedding(segment_ids), embedded_inputs.dtype)
       embedded_inputs = tf.cast(embedded_inputs, self.params["dtype"])
       inputs_padding = model_utils.get_padding(inputs)
       attention_bias = tf.cast(attention_bias, self.params["dtype"])
@@ -212,9 +232,16 @@ class Transformer(tf.keras.Model):
           decoder_self_attention_bias,
           attention_bias,
           training=training)
-      logits = self.embedding_softmax_layer(outputs, mode="linear")
-      logits = tf.cast(logits, tf.float32)
-      return logits
+      if self.output_xentropy:
+        # targets are the labels, the logits exist for a slice of positions at a time
+        return metrics.chunked_padded_cross_entropy_loss(
+            self._float32_logits, outputs, targets, self.params["label_smoothing"], self.params["vocab_size"],
+            self.params["logits_chunk_size"], training)
+      return self._float32_logits(outputs)
+
+  def _float32_logits(self, outputs):
+    logits = self.embedding_softmax_layer(outputs, mode="linear")
+    return tf.cast(logits, tf.float32)
 
   def _get_symbols_to_logits_fn(self, max_decode_length, training):
     """Returns a decoding function that calculates logits of the next tokens."""
@@ -373,7 +400,7 @@ class LayerNormalization(tf.keras.layers.Layer):
 
   def call(self, x, epsilon=1e-6):
     input_dtype = x.dtype
-    if input_dtype == tf.float16:
+    if input_dtype == tf.float16 or input_dtype == tf.bfloat16:
       x = tf.cast(x, tf.float32)
     mean = tf.reduce_mean(x, axis=[-1], keepdims=True)
     variance = tf.reduce_mean(tf.square(x - mean), axis=[-1], keepdims=True)
@@ -412,7 +439,7 @@ class PrePostProcessingWrapper(tf.keras.layers.Layer):
 
     # Postprocessing: apply dropout and residual connection
     if training:
-      y = tf.nn.dropout(y, rate=self.postprocess_dropout)
+      y = model_utils.dropout(y, self.postprocess_dropout)
 
     # TODO: should the layer_norm be applied after layer according to the paper?
     return x + y
@@ -440,8 +467,8 @@ class EncoderStack(tf.keras.layers.Layer):
       self_attention_layer = attention_layer.SelfAttention(
           params["hidden_size"], params["num_heads"],
           params["attention_dropout"])
-      feed_forward_network = ffn_layer.FeedForwardNetwork(
-          params["hidden_size"], params["filter_size"], params["relu_dropout"])
+      feed_forward_network = model_utils.FeedForwardNetwork(
+          params["hidden_size"], params["filter_size"], params["relu_dropout"], params.get("ffn_chunk_size", 0))
 
       self.layers.append([
           PrePostProcessingWrapper(self_attention_layer, params),
@@ -472,18 +499,26 @@ class EncoderStack(tf.keras.layers.Layer):
       Output of encoder layer stack.
       float32 tensor with shape [batch_size, input_length, hidden_size]
     """
+    recompute = training and self.params.get("recompute_encoder_layers")
     for n, layer in enumerate(self.layers):
       # Run inputs through the sublayers.
       self_attention_layer = layer[0]
       feed_forward_network = layer[1]
 
-      with tf.name_scope("layer_%d" % n):
+      def _encoder_layer(x, self_attention_layer=self_attention_layer, feed_forward_network=feed_forward_network):
         with tf.name_scope("self_attention"):
-          encoder_inputs = self_attention_layer(
-              encoder_inputs, attention_bias, training=training)
+          x = self_attention_layer(x, attention_bias, training=training)
         with tf.name_scope("ffn"):
-          encoder_inputs = feed_forward_network(
-              encoder_inputs, training=training)
+          x = feed_forward_network(x, training=training)
+        return x
+
+      with tf.name_scope("layer_%d" % n):
+        # the first call builds the sublayers, their variables can't be created inside recompute_grad
+        if recompute and self_attention_layer.built and feed_forward_network.built:
+          # only the layer input is kept, its activations are recomputed in the backward pass
+          encoder_inputs = model_utils.recompute_grad(_encoder_layer)(encoder_inputs)
+        else:
+          encoder_inputs = _encoder_layer(encoder_inputs)
 
     return self.output_normalization(encoder_inputs)
 
@@ -514,8 +549,8 @@ class DecoderStack(tf.keras.layers.Layer):
       enc_dec_attention_layer = attention_layer.Attention(
           params["hidden_size"], params["num_heads"],
           params["attention_dropout"])
-      feed_forward_network = ffn_layer.FeedForwardNetwork(
-          params["hidden_size"], params["filter_size"], params["relu_dropout"])
+      feed_forward_network = model_utils.FeedForwardNetwork(
+          params["hidden_size"], params["filter_size"], params["relu_dropout"], params.get("ffn_chunk_size", 0))
 
       self.layers.append([
           PrePostProcessingWrapper(self_attention_layer, params),
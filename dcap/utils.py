@@ -18,10 +18,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import contextlib
+import json
 import math
+import os
+import resource
+import signal
+import time
 import numpy as np
 from absl import logging
 import tensorflow as tf
+from official.transformer.v2 import ffn_layer
 
 # Very low numbers to represent -infinity. We do not actually use -Inf, since we
 # want to be able to multiply these values by zero to get zero. (-Inf * 0 = NaN)
@@ -125,6 +133,553 @@ def get_padding_bias(x, padding_value=0, dtype=tf.float32):
   return attention_bias
 
 
+def get_segment_ids(x, first_end_id, num_segments):
+  """Return the segment index of every token of back-to-back packed segments.
+
+  Segment i ends with the marker token first_end_id + i, the marker belongs to
+  the segment it ends.
+
+  Args:
+    x: int tensor with shape [batch_size, length]
+    first_end_id: int id of the end marker of the first segment
+    num_segments: int max number of segments
+
+  Returns:
+    int tensor with the same shape as x, values in [0, num_segments).
+  """
+  with tf.name_scope("segment_ids"):
+    is_end = tf.logical_and(x >= first_end_id, x < first_end_id + num_segments)
+    segment_ids = tf.cumsum(tf.cast(is_end, tf.int32), axis=-1, exclusive=True)
+    return tf.minimum(segment_ids, num_segments - 1)
+
+
+# [seed, number of random ops so far] of the recomputable functions being traced
+_recompute_seeds = []
+
+
+@contextlib.contextmanager
+def recompute_seed(seed):
+    """Random ops of dropout/random_normal in this context are seeded by seed (a [2] int64 tensor).
+
+    Running the same function in the context of the same seed again, e.g. to
+    recompute activations in the backward pass, draws the same values.
+    """
+    _recompute_seeds.append([seed, 0])
+    try:
+        yield
+    finally:
+        _recompute_seeds.pop()
+
+
+def new_recompute_seed():
+    return tf.random.uniform([2], maxval=2**31 - 1, dtype=tf.int64)
+
+
+def _next_recompute_seed():
+    """Returns the seed of the next random op inside recompute_grad, None outside of it."""
+    if not _recompute_seeds:
+        return None
+    state = _recompute_seeds[-1]
+    state[1] += 1
+    return state[0] + tf.constant([0, 1], tf.int64) * state[1]
+
+
+def dropout(x, rate):
+    """tf.nn.dropout, which drops the same units when recompute_grad reruns it."""
+    seed = _next_recompute_seed()
+    if seed is None:
+        return tf.nn.dropout(x, rate=rate)
+    keep = tf.random.stateless_uniform(tf.shape(x), seed=seed) >= rate
+    return tf.where(keep, x / (1.0 - rate), tf.zeros_like(x))
+
+
+def random_normal(shape):
+    """tf.random.normal, which draws the same values when recompute_grad reruns it."""
+    seed = _next_recompute_seed()
+    if seed is None:
+        return tf.random.normal(shape)
+    return tf.random.stateless_normal(shape, seed=seed)
+
+
+def recompute_grad(fn):
+    """Wraps fn by tf.recompute_grad: only its inputs are kept for the backward pass, which reruns fn.
+
+    Random ops in fn must be dropout/random_normal above. They are seeded by a
+    seed drawn once per call, so the rerun draws the same values and the
+    gradients match the forward pass.
+    """
+    @tf.recompute_grad
+    def _seeded_fn(seed, *args):
+        with recompute_seed(seed):
+            return fn(*args)
+
+    def _call(*args):
+        # inside another recompute_grad (or recompute_seed), the seed derives from its seed, so rerunning
+        # the outer function passes the same seed to fn again
+        seed = _next_recompute_seed()
+        return _seeded_fn(new_recompute_seed() if seed is None else seed, *args)
+    return _call
+
+
+def chunked_map(fn, x, chunk_size, dtype=None, with_index=False):
+    """Returns fn(x), computed on slices of chunk_size positions of x [batch_size, length, ...] in turn.
+
+    x is a tensor or a list of tensors of the same batch_size and length, which
+    are sliced together and passed to fn as arguments. fn must be position-wise,
+    i.e. map [batch_size, n, ...] to [batch_size, n, ...] and treat every position
+    on its own; its intermediate tensors exist for one slice at a time, and the
+    results are the same as fn(x). dtype is the dtype of fn's output, the dtype
+    of (the first) x by default. With with_index, fn also gets the index of the
+    slice (an int32 scalar tensor) as its first argument.
+    """
+    xs = list(x) if isinstance(x, (list, tuple)) else [x]
+    batch_size, length = tf.shape(xs[0])[0], tf.shape(xs[0])[1]
+    num_chunks = (length + chunk_size - 1) // chunk_size
+    padding = num_chunks * chunk_size - length
+    xs = [tf.pad(x, [[0, 0], [0, padding]] + [[0, 0]] * (len(x.shape) - 2)) for x in xs]
+    # one slice at a time (parallel_iterations=1), so the slices don't live at the same time;
+    # dtype rather than fn_output_signature, which needs TF 2.3+
+    def _fn(i):
+        slices = [x[:, i * chunk_size:(i + 1) * chunk_size] for x in xs]
+        return fn(i, *slices) if with_index else fn(*slices)
+    y = tf.map_fn(_fn, tf.range(num_chunks), dtype=dtype or xs[0].dtype, parallel_iterations=1)
+    # [num_chunks, batch_size, chunk_size, ...] -> [batch_size, length, ...]
+    y = tf.transpose(y, [1, 0] + list(range(2, len(y.shape))))
+    y = tf.reshape(y, tf.concat([[batch_size, num_chunks * chunk_size], tf.shape(y)[3:]], 0))
+    return y[:, :length]
+
+
+class FeedForwardNetwork(ffn_layer.FeedForwardNetwork):
+    """The feedforward network of official.transformer, whose dropout can be recomputed.
+
+    With chunk_size, the [batch_size, length, filter_size] intermediate exists
+    for chunk_size positions at a time, by chunked_map, and in training each
+    slice is recomputed in the backward pass instead of kept.
+    """
+
+    def __init__(self, hidden_size, filter_size, relu_dropout, chunk_size=0):
+        super(FeedForwardNetwork, self).__init__(hidden_size, filter_size, relu_dropout)
+        self.chunk_size = chunk_size
+
+    def get_config(self):
+        config = super(FeedForwardNetwork, self).get_config()
+        config["chunk_size"] = self.chunk_size
+        return config
+
+    def call(self, x, training):
+        length = x.shape[1]
+        # the first call builds the dense layers, their variables can't be created inside tf.map_fn;
+        # a single slice, e.g. a step of beam search, runs as a whole
+        if (not self.chunk_size or not self.filter_dense_layer.built
+                or (length is not None and length <= self.chunk_size)):
+            return self._call(x, training)
+        if not training:
+            return chunked_map(lambda chunk: self._call(chunk, training), x, self.chunk_size)
+        # the seed is taken once, outside of tf.map_fn, from the active recompute_seed context if any
+        # (e.g. a recomputed or reversible encoder layer), so rerunning that layer redraws the same
+        # dropout; every slice offsets it by its index to drop different units
+        seed = _next_recompute_seed()
+        if seed is None:
+            seed = new_recompute_seed()
+        fn = recompute_grad(lambda chunk: self._call(chunk, training))
+
+        def _chunk(i, chunk):
+            with recompute_seed(seed + tf.stack([tf.cast(i, tf.int64) + 1, 0])):
+                return fn(chunk)
+        return chunked_map(_chunk, x, self.chunk_size, with_index=True)
+
+    def _call(self, x, training):
+        output = self.filter_dense_layer(x)
+        if training:
+            output = dropout(output, self.relu_dropout)
+        return self.output_dense_layer(output)
+
+
+def accumulate_gradients(loss_fn, batch, num_micro_batches, variables):
+  """Return (loss, gradients) summed over micro-batches.
+
+  Micro-batches are stacked along axis 1 of every tensor in batch, so that a
+  distribution strategy still splits the examples (axis 0) across replicas.
+  The loss of each micro-batch is divided by num_micro_batches, so the result
+  is the gradient of the mean loss. Sparse (embedding) gradients are summed as
+  dense tensors.
+
+  Args:
+    loss_fn: function of one micro-batch (same structure as batch) returning a
+      scalar loss.
+    batch: nested structure of tensors with shape [batch_size, num_micro_batches, ...]
+    num_micro_batches: int number of micro-batches in batch
+    variables: list of variables to compute gradients for
+
+  Returns:
+    scalar loss tensor and a list of dense gradient tensors.
+  """
+  grads = [tf.zeros_like(v) for v in variables]
+  total_loss = tf.constant(0.0)
+  for idx in tf.range(num_micro_batches):
+    micro_batch = tf.nest.map_structure(lambda t: t[:, idx], batch)
+    with tf.GradientTape() as tape:
+      loss = tf.cast(loss_fn(micro_batch), tf.float32) / num_micro_batches
+    micro_grads = tape.gradient(loss, variables, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+    grads = [g + tf.convert_to_tensor(mg) for g, mg in zip(grads, micro_grads)]
+    total_loss += loss
+  return total_loss, grads
+
+
+class GradientAccumulationModel(tf.keras.Model):
+  """Functional model which applies the gradients summed over grad_accum_steps micro-batches per step.
+
+  A training batch has shape [batch_size, grad_accum_steps, ...], see
+  accumulate_gradients. optimizer.iterations, the learning rate schedule and
+  the checkpoint numbering all count optimizer steps, not micro-batches.
+  """
+
+  def __init__(self, inputs, outputs, grad_accum_steps, **kwargs):
+    super(GradientAccumulationModel, self).__init__(inputs, outputs, **kwargs)
+    self.grad_accum_steps = grad_accum_steps
+
+  def train_step(self, data):
+    use_loss_scale = isinstance(self.optimizer, tf.compat.v2.keras.mixed_precision.experimental.LossScaleOptimizer)
+
+    def _loss_fn(micro_batch):
+      x, y = micro_batch
+      loss = self.compiled_loss(y, self(x, training=True), regularization_losses=self.losses)
+      return self.optimizer.get_scaled_loss(loss) if use_loss_scale else loss
+
+    _, grads = accumulate_gradients(_loss_fn, data, self.grad_accum_steps, self.trainable_variables)
+    if use_loss_scale:
+      grads = self.optimizer.get_unscaled_gradients(grads)
+    self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
+    return {m.name: m.result() for m in self.metrics}
+
+
+def save_checkpoint(ckpt_mgr, checkpoint_number, options=None):
+    """ckpt_mgr.save, which passes options only if given (CheckpointManager.save of old TF takes no options)."""
+    if options is None:
+        return ckpt_mgr.save(checkpoint_number=checkpoint_number)
+    return ckpt_mgr.save(checkpoint_number=checkpoint_number, options=options)
+
+
+class InterimCheckpoint(tf.keras.callbacks.Callback):
+    """Saves checkpoints within an epoch, every N steps and/or seconds, and on SIGTERM.
+
+    On SIGTERM the current step finishes, a checkpoint is saved and training stops,
+    so a preempted job loses at most the steps since the last interim checkpoint.
+    Checkpoints are numbered by the global step.
+    """
+    def __init__(self, ckpt_mgr, init_steps, every_n_steps=0, every_n_secs=0, options=None):
+        super(InterimCheckpoint, self).__init__()
+        self.ckpt_mgr = ckpt_mgr
+        self.steps = init_steps
+        self.every_n_steps = every_n_steps
+        self.every_n_secs = every_n_secs
+        self.options = options
+        self.preempted = False
+        self._last_save_step, self._last_save_time = init_steps, time.time()
+        self._prev_handler = None
+
+    def _on_sigterm(self, signum, frame):
+        logging.warning('received SIGTERM, save a checkpoint after the current step and stop training')
+        self.preempted = True
+
+    def on_train_begin(self, logs=None):
+        self._prev_handler = signal.signal(signal.SIGTERM, self._on_sigterm)
+
+    def on_train_end(self, logs=None):
+        signal.signal(signal.SIGTERM, self._prev_handler or signal.SIG_DFL)
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.after_steps(1)
+
+    def after_steps(self, num_steps):
+        """Called after num_steps more training steps, returns True when training should stop."""
+        self.steps += num_steps
+        if (self.preempted
+                or (self.every_n_steps and self.steps - self._last_save_step >= self.every_n_steps)
+                or (self.every_n_secs and time.time() - self._last_save_time >= self.every_n_secs)):
+            path = save_checkpoint(self.ckpt_mgr, self.steps, self.options)
+            logging.info(f'saved interim checkpoint {path} at step {self.steps}')
+            self._last_save_step, self._last_save_time = self.steps, time.time()
+        if self.preempted:
+            self.model.stop_training = True
+        return self.preempted
+
+
+class CompileMonitor(tf.keras.callbacks.Callback):
+    """Logs the steps which (re)compile the train function, and warns when there are more than expected.
+
+    With XLA the train step is compiled once for every distinct input shape, so
+    a run with static (bucketed) shapes compiles at most max_compiles times. A
+    step is counted as compiling when it's the first one, or slow_factor times
+    slower than the median of the recent steps.
+    """
+    def __init__(self, max_compiles, slow_factor=10, window=100):
+        super(CompileMonitor, self).__init__()
+        self.max_compiles = max_compiles
+        self.slow_factor = slow_factor
+        self.num_compiles = 0
+        self._times = collections.deque(maxlen=window)
+        self._start = None
+
+    def record(self, step, seconds):
+        if self._times and seconds <= self.slow_factor * np.median(self._times):
+            self._times.append(seconds)
+            return
+        self.num_compiles += 1
+        logging.info(f'step {step} took {seconds:.1f}s, it probably traced/compiled the train function (#{self.num_compiles})')
+        if self.num_compiles > self.max_compiles:
+            logging.warning(f'the train function was compiled {self.num_compiles} times, more than the {self.max_compiles} '
+                            'input shape(s) expected, check that the input shapes are static')
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._start = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.record(batch, time.time() - self._start)
+
+    def on_train_end(self, logs=None):
+        train_function = getattr(self.model, 'train_function', None)
+        if hasattr(train_function, 'experimental_get_tracing_count') and train_function.experimental_get_tracing_count() > 1:
+            logging.warning(f'the train function was traced {train_function.experimental_get_tracing_count()} times')
+
+
+def current_rss_mb():
+    """Resident set size of this process in MB (peak RSS where /proc isn't available)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def instrument_batches(ds, handovers):
+    """Returns ds of ((inputs, targets), labels) batches, which reports every batch handed to the train step.
+
+    A (time, examples, real_tokens, total_tokens) tuple is appended to the deque
+    handovers when the train step gets the batch, for StepStats.
+
+    The input wait of StepStats is only meaningful if nothing buffers batches
+    after this stage: ds must not be prefetched afterwards, and the prefetch that
+    tf.data (TF 2.8+) injects after the last stage is turned off here. The
+    iterators of multi-device strategies prefetch too, so there the input wait
+    is the time to dequeue an already produced batch.
+    """
+    def _note_batch(examples, real_tokens, total_tokens):
+        handovers.append((time.time(), int(examples), int(real_tokens), int(total_tokens)))
+        return 0
+
+    def _instrument(features, labels):
+        inputs, targets = features
+        examples = tf.size(targets) // tf.shape(targets)[-1]
+        real_tokens = tf.math.count_nonzero(inputs) + tf.math.count_nonzero(targets)
+        total_tokens = tf.size(inputs, out_type=tf.int64) + tf.size(targets, out_type=tf.int64)
+        noted = tf.py_function(_note_batch, [examples, real_tokens, total_tokens], tf.int32)
+        with tf.control_dependencies([noted]):
+            return tf.nest.map_structure(tf.identity, (features, labels))
+
+    # no prefetch after this stage, so it runs when the train step asks for the batch
+    ds = ds.map(_instrument)
+    options = tf.data.Options()
+    if hasattr(options.experimental_optimization, 'inject_prefetch'):
+        options.experimental_optimization.inject_prefetch = False
+    return ds.with_options(options)
+
+
+class StepStats(tf.keras.callbacks.Callback):
+    """Records per-step input wait, compute time, throughput, padding and RSS.
+
+    The input wait of a step is from the step begin to the hand-over of its batch
+    (see instrument_batches), the compute time is the rest of the step. Every
+    `window` steps, the percentiles of the window are logged, written to
+    `{log_dir}/step-stats.step-{init_steps}.csv` and (with a summary_writer) to
+    TensorBoard; they're also added to the epoch logs, i.e. the CSV history.
+    """
+    COLUMNS = ['step', 'step_ms_p50', 'step_ms_p90', 'step_ms_p99', 'input_ms_p50', 'input_ms_p90', 'input_ms_p99',
+               'compute_ms_p50', 'compute_ms_p90', 'compute_ms_p99', 'input_fraction', 'examples_per_sec',
+               'tokens_per_sec', 'padding_fraction', 'rss_mb']
+
+    def __init__(self, log_dir, init_steps, handovers=None, window=100, summary_writer=None):
+        super(StepStats, self).__init__()
+        self.steps = init_steps
+        self.window = window
+        self.summary_writer = summary_writer
+        self.csv_file = open(os.path.join(log_dir, f'step-stats.step-{init_steps}.csv'), 'w')
+        self.csv_file.write(','.join(self.COLUMNS) + '\n')
+        self._handovers = handovers if handovers is not None else collections.deque()
+        self._records = []
+        self._last_row = None
+        self._begin = None
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._begin = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        end = time.time()
+        self.steps += 1
+        handover, examples, real_tokens, total_tokens = self._handovers.popleft() if self._handovers else (self._begin, 0, 0, 0)
+        handover = min(max(handover, self._begin), end)
+        self._records.append((end - self._begin, handover - self._begin, end - handover, examples, real_tokens, total_tokens))
+        if len(self._records) >= self.window:
+            self._flush()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self._records:
+            self._flush()  # so every epoch row of the CSV history has the same columns
+        if logs is not None and self._last_row:
+            logs.update({f'stats_{name}': self._last_row[name]
+                         for name in ['step_ms_p50', 'input_fraction', 'examples_per_sec', 'tokens_per_sec', 'padding_fraction', 'rss_mb']})
+
+    def on_train_end(self, logs=None):
+        if self._records:
+            self._flush()
+        self.csv_file.close()
+
+    def _flush(self):
+        records = np.array(self._records, dtype=np.float64)
+        self._records = []
+        step_secs, input_secs, compute_secs = records[:, 0], records[:, 1], records[:, 2]
+        total_secs = max(step_secs.sum(), 1e-9)
+        row = {'step': self.steps}
+        for name, values in [('step', step_secs), ('input', input_secs), ('compute', compute_secs)]:
+            for q in [50, 90, 99]:
+                row[f'{name}_ms_p{q}'] = float(np.percentile(values, q) * 1000)
+        row['input_fraction'] = float(input_secs.sum() / total_secs)
+        row['examples_per_sec'] = float(records[:, 3].sum() / total_secs)
+        row['tokens_per_sec'] = float(records[:, 4].sum() / total_secs)
+        row['padding_fraction'] = float(1 - records[:, 4].sum() / max(records[:, 5].sum(), 1))
+        row['rss_mb'] = current_rss_mb()
+        self._last_row = row
+
+        logging.info(f'step stats until step {self.steps}: step p50/p90/p99 = {row["step_ms_p50"]:.1f}/{row["step_ms_p90"]:.1f}/{row["step_ms_p99"]:.1f} ms, '
+                     f'input wait {row["input_fraction"]:.1%} ({"input" if row["input_fraction"] > 0.1 else "compute"}-bound), '
+                     f'{row["examples_per_sec"]:.1f} examples/s, {row["tokens_per_sec"]:.0f} real tokens/s, '
+                     f'padding {row["padding_fraction"]:.1%}, rss {row["rss_mb"]:.0f} MB')
+        self.csv_file.write(','.join(f'{row[name]:g}' for name in self.COLUMNS) + '\n')
+        self.csv_file.flush()
+        if self.summary_writer is not None:
+            with self.summary_writer.as_default():
+                for name in self.COLUMNS[1:]:
+                    tf.summary.scalar(f'step_stats/{name}', row[name], step=self.steps)
+
+
+def write_top_ops(log_dir, out_path, top_n=50):
+    """Writes the top_n ops by self time of the latest profile in log_dir to out_path as a TSV table.
+
+    The table is made by the tensorflow_stats tool of the TensorBoard profile
+    plugin; FLOPs and memory are derived from its measured FLOP rate and memory
+    bandwidth, so they're empty for ops without cost analysis.
+    """
+    xplanes = sorted(tf.io.gfile.glob(os.path.join(log_dir, 'plugins', 'profile', '*', '*.xplane.pb')))
+    if not xplanes:
+        logging.warning(f'no profile found in {log_dir}')
+        return
+    run_dir = os.path.dirname(xplanes[-1])  # runs are named by time
+    xplanes = [path for path in xplanes if os.path.dirname(path) == run_dir]
+    try:
+        from tensorflow.python.profiler.internal import _pywrap_profiler
+        try:
+            data, success = _pywrap_profiler.xspace_to_tools_data(xplanes, 'tensorflow_stats')
+        except TypeError:  # TF 2.11+ takes tool options
+            data, success = _pywrap_profiler.xspace_to_tools_data(xplanes, 'tensorflow_stats', {})
+        assert success, 'tensorflow_stats tool failed'
+        tables = json.loads(data)
+    except Exception:
+        logging.exception(f'can\'t summarize ops of profile {run_dir}, open it with TensorBoard instead')
+        return
+
+    rows = []
+    for table in (tables if isinstance(tables, list) else [tables]):
+        col_ids = [col['id'] for col in table['cols']]
+        rows += [{col_id: cell.get('v') if cell else None for col_id, cell in zip(col_ids, row['c'])} for row in table['rows']]
+    rows.sort(key=lambda row: -(row.get('total_self_time') or 0))
+    total_self_time = sum(row.get('total_self_time') or 0 for row in rows) or 1
+
+    def _per_op(row, rate_column, scale):
+        # rates are per second, self time is in us
+        rate = row.get(rate_column)
+        return f'{rate * row["total_self_time"] * 1e-6 * scale:.3f}' if rate and row.get('total_self_time') else ''
+
+    with tf.io.gfile.GFile(out_path, 'w') as f:
+        f.write('\t'.join(['rank', 'host_or_device', 'type', 'operation', 'occurrences', 'self_time_us', 'self_time_percent',
+                           'avg_self_time_us', 'gflops', 'memory_mb', 'bound_by']) + '\n')
+        for rank, row in enumerate(rows[:top_n], 1):
+            f.write('\t'.join(str(v) for v in [
+                rank, row.get('host_or_device', ''), row.get('type', ''), row.get('operation', ''), row.get('occurrences', ''),
+                f'{row.get("total_self_time") or 0:.1f}', f'{100 * (row.get("total_self_time") or 0) / total_self_time:.2f}',
+                f'{row.get("avg_self_time") or 0:.1f}',
+                _per_op(row, 'measured_flop_rate', 1),  # GFLOPs/s
+                _per_op(row, 'measured_memory_bw', 1024),  # GBytes/s
+                row.get('bound_by', '')]) + '\n')
+    logging.info(f'wrote the top {min(top_n, len(rows))} ops of profile {run_dir} to {out_path}')
+
+
+class ProfilerCallback(tf.keras.callbacks.Callback):
+    """Profiles a range of train or predict steps with the TF profiler.
+
+    profile_steps is "first,last", the 1-based steps of this run to profile. The
+    trace is saved in log_dir/plugins/profile for TensorBoard, and the top_n ops
+    by self time are written to log_dir/top-ops.{mode}.tsv.
+    """
+    def __init__(self, log_dir, profile_steps, mode, top_n=50):
+        super(ProfilerCallback, self).__init__()
+        try:
+            self.first_step, self.last_step = [int(v) for v in profile_steps.split(',')]
+        except ValueError:
+            raise ValueError(f'profile_steps must be a pair of integers "first,last": {profile_steps}')
+        if not 0 < self.first_step <= self.last_step:
+            raise ValueError(f'invalid profile_steps: {profile_steps}')
+        self.log_dir = log_dir
+        self.mode = mode
+        self.top_n = top_n
+        self.steps = 0
+        self.profiling = False
+
+    def _step_begin(self):
+        self.steps += 1
+        if self.steps == self.first_step:
+            logging.info(f'start profiling {self.mode} steps {self.first_step}-{self.last_step}')
+            if hasattr(tf.profiler, 'experimental') and hasattr(tf.profiler.experimental, 'start'):
+                tf.profiler.experimental.start(self.log_dir)
+            else:
+                # TF < 2.2 profiles by the trace of tf.summary, which has no xplane for write_top_ops
+                tf.summary.trace_on(graph=False, profiler=True)
+            self.profiling = True
+
+    def _step_end(self):
+        if self.profiling and self.steps >= self.last_step:
+            self._stop()
+
+    def _stop(self):
+        if hasattr(tf.profiler, 'experimental') and hasattr(tf.profiler.experimental, 'stop'):
+            tf.profiler.experimental.stop()
+            write_top_ops(self.log_dir, os.path.join(self.log_dir, f'top-ops.{self.mode}.tsv'), self.top_n)
+        else:
+            with tf.summary.create_file_writer(self.log_dir).as_default():
+                tf.summary.trace_export(f'profile-{self.mode}', step=self.steps, profiler_outdir=self.log_dir)
+            logging.info(f'profile of {self.mode} steps written to {self.log_dir}, top ops need TF 2.2+')
+        self.profiling = False
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._step_begin()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._step_end()
+
+    def on_predict_batch_begin(self, batch, logs=None):
+        self._step_begin()
+
+    def on_predict_batch_end(self, batch, logs=None):
+        self._step_end()
+
+    def on_train_end(self, logs=None):
+        if self.profiling:
+            self._stop()
+
+    def on_predict_end(self, logs=None):
+        if self.profiling:
+            self._stop()
+
+
 class TensorBoardFix(tf.keras.callbacks.TensorBoard):
     """Build-in TensorBoard can't resume training_step, so fix it"""
     def __init__(self, start_step=0, *args, **kwargs):